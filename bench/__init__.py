@@ -0,0 +1,8 @@
+"""
+Benchmarks for faces detection, bundle training and matching.
+
+Synthetic galleries and photos are generated on the fly (see synthetic)
+so results are reproducible offline, run them with:
+
+    $ python -m bench.run --help
+"""
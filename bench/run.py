@@ -0,0 +1,471 @@
+#!/usr/bin/python
+"""
+Times every stage of the faces pipeline over a synthetic gallery and
+synthetic photos (see synthetic):
+
+    decode        decoding the photos
+    detect        upright faces detection on decoded photos
+    rotation      rotated detection fallback (ROTATE_ANGLES)
+    crop          cropping the known faces boxes to grayscale
+    bundle_build  building the gallery bundle from its images
+    bundle_build_fast
+                  same in fast training mode, with its accuracy compared
+                  to the exact build
+    cache_save    saving the bundle cache
+    cache_load    loading the bundle cache
+    bundle_update_removed, bundle_update_added
+                  updating the cached bundle of a gallery copy after
+                  adding and after removing an image
+    bundle_update_full
+                  same with INCREMENTAL off, which builds it again
+    cold_start    starting faces.py (--help), no backend is loaded
+    cold_start_detect
+                  importing the detection backend, for comparison
+    ingest        normalizing the gallery images (see ingest)
+    match         matching probe faces against the bundle
+    match_float16, match_int8
+                  same with compact weights and eigenfaces, with their
+                  accuracy and agreement compared to float64 matches,
+                  without re-ranking too, and the memory they save: the
+                  cache pages resident after matching on the float64
+                  and compact bundles, freshly loaded (Linux only)
+
+Detection stages are skipped if OpenCV isn't available. Results are
+written as JSON, the best of `repeat` runs is the stage time, and can
+be compared against a previous run. Stages with a `consistent` value
+check their results, the run fails if any of them is false:
+
+    $ python -m bench.run -o baseline.json
+    $ python -m bench.run --compare baseline.json
+"""
+import os
+import sys
+import json
+import shutil
+import subprocess
+import optparse
+import platform
+import tempfile
+import Image
+
+from copy import copy
+from os import listdir
+from os.path import abspath, basename, dirname, join
+from timeit import default_timer
+
+from numpy import median
+from numpy.random import RandomState
+
+from bench.synthetic import make_gallery, make_photos, draw_face, \
+                            MANIFEST_NAME, PERSON_FORMAT
+from pyfaces import eigenfaces, index
+from pyfaces.eigenfaces import create_face_bundle, parse_gallery, \
+                               save_bundle, load_bundle, match_bundle, \
+                               gallery_index, get_gallery_bundle, \
+                               relative_names
+from pyfaces.pyfaces import THRESHOLD
+from ingest import ingest_gallery
+
+
+ROOT = dirname(dirname(abspath(__file__)))
+
+
+PEOPLE          = 20
+IMAGES          = 5
+FACE_SIZE       = (92, 112)
+PHOTOS          = 5
+PHOTO_FACES     = 3
+PHOTO_SIZE      = (1024, 768)
+PHOTO_FACE_SIZE = (160, 200)
+PROBES          = 50
+REPEAT          = 3
+SEED            = 0
+TOLERANCE       = 0.2
+
+
+def timed(func, repeat=REPEAT):
+    """ Runs `func` `repeat` times, returns (durations, last result) """
+    durations, result = [], None
+    for i in xrange(repeat):
+        start = default_timer()
+        result = func()
+        durations.append(default_timer() - start)
+    return durations, result
+
+
+def stage(durations, items, **extra):
+    """ Returns the JSON entry for a stage run over `items` items """
+    value = {'best': min(durations), 'median': float(median(durations)),
+             'runs': durations, 'items': items,
+             'per_item': min(durations) / (items or 1)}
+    value.update(extra)
+    return value
+
+
+def accuracy(matches, expected):
+    """ Returns the fraction of `matches` labeled as `expected` """
+    right = sum(1 for (dist, match, label), name in zip(matches, expected)
+                        if label == name)
+    return float(right) / (len(matches) or 1)
+
+
+def skipped(reason):
+    return {'skipped': reason}
+
+
+def load_detector():
+    """ Returns detect.facedetect module or the reason it can't be used """
+    try:
+        from detect import facedetect
+    except ImportError, e:
+        return None, str(e)
+    return facedetect, None
+
+
+def run(workdir, people=PEOPLE, images=IMAGES, face_size=FACE_SIZE,
+        photos=PHOTOS, photo_faces=PHOTO_FACES, photo_size=PHOTO_SIZE,
+        photo_face_size=PHOTO_FACE_SIZE, probes=PROBES, repeat=REPEAT,
+        seed=SEED, threshold=THRESHOLD, fast_components=None):
+    """ Runs every stage on data generated at `workdir`, returns the
+    results dict """
+    gallery, photos_dir = join(workdir, 'people'), join(workdir, 'photos')
+    features = make_gallery(gallery, people, images, face_size, seed)
+    manifest = make_photos(photos_dir, photos, photo_faces, photo_size,
+                           photo_face_size, features, seed)
+    names = sorted(name for name in listdir(photos_dir)
+                            if name != MANIFEST_NAME)
+    stages = {}
+
+    def decode():
+        decoded = []
+        for name in names:
+            img = Image.open(join(photos_dir, name))
+            img.load()
+            decoded.append(img)
+        return decoded
+    durations, decoded = timed(decode, repeat)
+    stages['decode'] = stage(durations, len(names))
+
+    facedetect, reason = load_detector()
+    if facedetect is None:
+        stages['detect'] = stages['rotation'] = skipped(reason)
+    else:
+        facedetect._detect(decoded[0]) # load cascades out of the timing
+        durations, found = timed(lambda: [facedetect._detect(img)
+                                              for img in decoded], repeat)
+        stages['detect'] = stage(durations, len(decoded),
+                                 expected=sum(map(len, manifest.values())),
+                                 found=sum(map(len, found)))
+        durations, found = timed(lambda: [facedetect._detect_rotated(img,
+                                            facedetect.ROTATE_ANGLES, False)
+                                              for img in decoded], repeat)
+        stages['rotation'] = stage(durations, len(decoded),
+                                   angles=list(facedetect.ROTATE_ANGLES))
+
+    def crop():
+        return [img.crop(box[0] + box[1]).convert('L')
+                    for name, img in zip(names, decoded)
+                        for box in manifest[name]]
+    durations, crops = timed(crop, repeat)
+    stages['crop'] = stage(durations, len(crops))
+
+    stages['cold_start'] = stage(command_times([join(ROOT, 'faces.py'),
+                                                '--help'], repeat), 1)
+    stages['cold_start_detect'] = stage(command_times(['-c',
+                                                       'import detect.'
+                                                       'facedetect'],
+                                                      repeat), 1)
+
+    images_list, labels = parse_gallery(gallery)
+    ingested = join(workdir, 'ingested')
+    durations, results = timed(lambda: list(ingest_gallery(gallery, ingested,
+                                                           face_size,
+                                                           force=True)),
+                               repeat)
+    stages['ingest'] = stage(durations, len(images_list),
+                             errors=sum(1 for result in results
+                                            if 'error' in result))
+    durations, bundle = timed(lambda: create_face_bundle(gallery, images_list,
+                                                         labels), repeat)
+    bundle.index = gallery_index(bundle.weights)
+    stages['bundle_build'] = stage(durations, len(images_list),
+                                   components=bundle.components)
+
+    cache_file = join(workdir, 'bench.cache')
+    durations, result = timed(lambda: save_bundle(cache_file, bundle, None),
+                              repeat)
+    stages['cache_save'] = stage(durations, 1)
+
+    def cache_load():
+        loaded, stamp = load_bundle(cache_file)
+        loaded.weights.sum() # memory mapped, touch the pages
+        return loaded
+    durations, bundle = timed(cache_load, repeat)
+    stages['cache_load'] = stage(durations, 1)
+    stages.update(update_stages(gallery, join(workdir, 'updated')))
+
+    # probes are new images of gallery people, plus the photos crops
+    rng = RandomState(seed + 1)
+    people_probes = [rng.randint(people) for i in xrange(probes)]
+    faces = [draw_face(features[person], face_size, rng)
+                for person in people_probes] + crops
+    durations, matches = timed(lambda: match_bundle(bundle, faces, threshold),
+                               repeat)
+    expected = [PERSON_FORMAT % person for person in people_probes] + \
+               [PERSON_FORMAT % box[2] for name in names
+                    for box in manifest[name]]
+    stages['match'] = stage(durations, len(faces),
+                            matched=sum(1 for match in matches if match[1]),
+                            accuracy=accuracy(matches, expected))
+
+    for name in ('float16', 'int8'):
+        stages['match_' + name] = compact_stage(bundle, faces, threshold,
+                                                name, expected, matches,
+                                                workdir, repeat)
+
+    durations, fast = timed(lambda: create_face_bundle(gallery, images_list,
+                                                       labels,
+                                                       fast_components,
+                                                       fast=True), repeat)
+    fast.index = gallery_index(fast.weights)
+    fast_matches = match_bundle(fast, faces, threshold)
+    common = min(fast.components, bundle.components)
+    evals_error = abs(fast.evals[:common] - bundle.evals[:common]) / \
+                    bundle.evals[:common]
+    # compared with the exact bundle searched on as many eigenfaces
+    exact_matches = match_bundle(bundle, faces, threshold, common)
+    stages['bundle_build_fast'] = stage(durations, len(images_list),
+                                        components=fast.components,
+                                        accuracy=accuracy(fast_matches,
+                                                          expected),
+                                        agreement=agreement(fast_matches,
+                                                            exact_matches),
+                                        evals_error=float(evals_error.max()))
+
+    return {'config': {'people': people, 'images': images,
+                       'face_size': list(face_size), 'photos': photos,
+                       'photo_faces': photo_faces,
+                       'photo_size': list(photo_size),
+                       'photo_face_size': list(photo_face_size),
+                       'probes': probes, 'repeat': repeat, 'seed': seed,
+                       'threshold': threshold,
+                       'fast_components': fast_components},
+            'environment': {'python': platform.python_version(),
+                            'platform': platform.platform(),
+                            'machine': platform.machine()},
+            'stages': stages}
+
+
+def command_times(arguments, repeat=REPEAT):
+    """ Returns the durations of running python with `arguments` from the
+    repository root `repeat` times """
+    environment = dict(os.environ)
+    paths = [ROOT, environment.get('PYTHONPATH')]
+    environment['PYTHONPATH'] = os.pathsep.join(filter(None, paths))
+    with open(os.devnull, 'w') as devnull:
+        durations, result = timed(lambda: subprocess.call(
+                                            [sys.executable] + arguments,
+                                            stdout=devnull, cwd=ROOT,
+                                            env=environment), repeat)
+    return durations
+
+
+def update_stages(gallery, workdir):
+    """ Returns the bundle update stages, run on a copy of `gallery` at
+    `workdir`. Each stage changes the gallery once and times get_bundle,
+    its bundle is consistent if it holds the images as listed """
+    shutil.copytree(gallery, workdir)
+    get_gallery_bundle(workdir) # the cached bundle to update
+    images_list, labels = parse_gallery(workdir)
+
+    def changed(change):
+        change()
+        durations, bundle = timed(lambda: get_gallery_bundle(workdir), 1)
+        listed = parse_gallery(workdir)[0]
+        return stage(durations, len(listed),
+                     consistent=bundle.images_list == \
+                                    relative_names(workdir, listed) and \
+                                len(bundle.weights) == len(listed),
+                     incremental=bundle.changed > 0)
+
+    # adding first, bundles with less images keep less eigenfaces
+    stages = {}
+    added = join(dirname(images_list[0]), 'added-' + basename(images_list[0]))
+    stages['bundle_update_added'] = changed(lambda: shutil.copy(images_list[0],
+                                                                added))
+    stages['bundle_update_removed'] = changed(lambda:
+                                                  os.remove(images_list[1]))
+    incremental, eigenfaces.INCREMENTAL = eigenfaces.INCREMENTAL, False
+    try:
+        stages['bundle_update_full'] = changed(lambda:
+                                                   os.remove(images_list[2]))
+    finally:
+        eigenfaces.INCREMENTAL = incremental
+    return stages
+
+
+def compact_stage(bundle, faces, threshold, dtype, expected, exact,
+                  workdir, repeat=REPEAT):
+    """ Times matching `faces` on `bundle` with weights and eigenfaces
+    stored as `dtype`, `exact` are the float64 matches. Bundles are saved
+    at `workdir` and loaded again, as get_bundle serves them """
+    settings = eigenfaces.WEIGHTS_DTYPE, eigenfaces.EIGENFACES_DTYPE, \
+               index.RERANK
+    original_file = join(workdir, 'float64.cache')
+    original = reopened(bundle, original_file)
+    match_bundle(original, faces, threshold)
+    compact_file = join(workdir, dtype + '.cache')
+    eigenfaces.WEIGHTS_DTYPE = eigenfaces.EIGENFACES_DTYPE = dtype
+    try:
+        compact = reopened(bundle, compact_file)
+        durations, matches = timed(lambda: match_bundle(compact, faces,
+                                                        threshold), repeat)
+        resident = mapped_memory(compact_file)
+        index.RERANK = 0
+        unranked = match_bundle(compact, faces, threshold)
+    finally:
+        eigenfaces.WEIGHTS_DTYPE, eigenfaces.EIGENFACES_DTYPE, \
+            index.RERANK = settings
+    original_resident = mapped_memory(original_file)
+    return stage(durations, len(faces),
+                 accuracy=accuracy(matches, expected),
+                 agreement=agreement(matches, exact),
+                 agreement_unranked=agreement(unranked, exact),
+                 resident=resident,
+                 memory_ratio=float(original_resident) / resident
+                                if resident else None)
+
+
+def reopened(bundle, path):
+    """ Returns `bundle` with its index (and compact eigenfaces) built for
+    the current settings, saved at `path` and loaded back """
+    built = copy(bundle)
+    built.index = gallery_index(bundle.weights)
+    built.compact = built.norms = None
+    save_bundle(path, built, None)
+    return load_bundle(path)[0]
+
+
+def mapped_memory(path):
+    """ Returns the bytes of `path` mappings resident in this process, None
+    if /proc/self/smaps isn't available """
+    try:
+        with open('/proc/self/smaps') as smaps:
+            lines = smaps.readlines()
+    except IOError:
+        return None
+    path, mapped, total = os.path.realpath(path), False, 0
+    for line in lines:
+        fields = line.split()
+        if '-' in fields[0] and len(fields) >= 5: # mapping header line
+            mapped = len(fields) >= 6 and fields[5] == path
+        elif mapped and fields[0] == 'Rss:':
+            total += int(fields[1]) * 1024
+    return total
+
+
+def agreement(matches, exact):
+    """ Returns the fraction of `matches` with the same image as `exact` """
+    same = sum(1 for match, reference in zip(matches, exact)
+                    if match[1] == reference[1])
+    return float(same) / (len(exact) or 1)
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """ Compares `results` stages best times against `baseline`, returns
+    [(stage, baseline, current, ratio, regressed), ...] for stages timed
+    on both, a stage regressed if it's slower than `tolerance` times the
+    baseline """
+    rows = []
+    for name, value in sorted(results['stages'].iteritems()):
+        base = baseline.get('stages', {}).get(name, {})
+        if 'best' not in value or 'best' not in base:
+            continue
+        ratio = value['best'] / (base['best'] or 1e-9)
+        rows.append((name, base['best'], value['best'], ratio,
+                     ratio > 1 + tolerance))
+    return rows
+
+
+def size(value):
+    """ Parses a WIDTHxHEIGHT option value """
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('-p', '--people', type='int', default=PEOPLE,
+                      dest='people')
+    parser.add_option('-n', '--images', type='int', default=IMAGES,
+                      dest='images', help='images per person')
+    parser.add_option('-s', '--face-size', default='%dx%d' % FACE_SIZE,
+                      dest='face_size')
+    parser.add_option('-P', '--photos', type='int', default=PHOTOS,
+                      dest='photos')
+    parser.add_option('-f', '--photo-faces', type='int', default=PHOTO_FACES,
+                      dest='photo_faces')
+    parser.add_option('-S', '--photo-size', default='%dx%d' % PHOTO_SIZE,
+                      dest='photo_size')
+    parser.add_option('-F', '--photo-face-size',
+                      default='%dx%d' % PHOTO_FACE_SIZE,
+                      dest='photo_face_size')
+    parser.add_option('-q', '--probes', type='int', default=PROBES,
+                      dest='probes')
+    parser.add_option('-r', '--repeat', type='int', default=REPEAT,
+                      dest='repeat')
+    parser.add_option('-T', '--threshold', type='float', default=THRESHOLD,
+                      dest='threshold')
+    parser.add_option('-k', '--fast-components', type='int', default=None,
+                      dest='fast_components',
+                      help='eigenfaces for the fast training build')
+    parser.add_option('--seed', type='int', default=SEED, dest='seed')
+    parser.add_option('-o', '--output', dest='output')
+    parser.add_option('-c', '--compare', dest='compare',
+                      help='baseline results to compare against')
+    parser.add_option('-t', '--tolerance', type='float', default=TOLERANCE,
+                      dest='tolerance')
+    parser.add_option('-w', '--workdir', dest='workdir',
+                      help='keep generated data here')
+    (options, args) = parser.parse_args()
+
+    workdir = options.workdir or tempfile.mkdtemp(prefix='faces-bench-')
+    try:
+        results = run(workdir, options.people, options.images,
+                      size(options.face_size), options.photos,
+                      options.photo_faces, size(options.photo_size),
+                      size(options.photo_face_size), options.probes,
+                      options.repeat, options.seed, options.threshold,
+                      options.fast_components)
+    finally:
+        if not options.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    else:
+        print json.dumps(results, indent=2, sort_keys=True)
+
+    inconsistent = [name for name, value in sorted(results['stages']
+                                                            .iteritems())
+                        if value.get('consistent') is False]
+    if inconsistent:
+        print >> sys.stderr, 'Inconsistent results on %s' % \
+                                ', '.join(inconsistent)
+
+    if options.compare:
+        with open(options.compare) as source:
+            baseline = json.load(source)
+        if baseline.get('config') != results['config']:
+            print >> sys.stderr, 'Warning: baseline was run with a ' \
+                                 'different configuration'
+        rows = compare(results, baseline, options.tolerance)
+        for name, base, current, ratio, regressed in rows:
+            print >> sys.stderr, '%-14s %10.4fs %10.4fs %6.2fx%s' % \
+                    (name, base, current, ratio,
+                     '  REGRESSION' if regressed else '')
+        if any(row[-1] for row in rows):
+            sys.exit(1)
+    if inconsistent:
+        sys.exit(1)
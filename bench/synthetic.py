@@ -0,0 +1,117 @@
+"""
+Synthetic galleries and photos for benchmarks.
+
+Faces are drawn as a head ellipse with eyes, nose and mouth, every
+person gets its own proportions and tone and every image of a person
+is a slightly shifted and noisy variation, so the eigenfaces method
+has something to learn. Photos paste a known number of faces over a
+noisy background and record where they are.
+"""
+import json
+import Image, ImageDraw
+
+from os import makedirs
+from os.path import exists, join
+
+from numpy import asarray, clip, uint8
+from numpy.random import RandomState
+
+
+PERSON_FORMAT = 'person%04d'
+IMAGE_FORMAT  = 'face%03d.png'
+PHOTO_FORMAT  = 'photo%04d.jpg'
+MANIFEST_NAME = 'manifest.json'
+NOISE         = 12
+
+
+def person_features(rng):
+    """ Returns random drawing parameters for a person """
+    return {'head': (rng.uniform(0.30, 0.42), rng.uniform(0.38, 0.48)),
+            'eyes': (rng.uniform(0.14, 0.22), rng.uniform(0.36, 0.44)),
+            'mouth': (rng.uniform(0.10, 0.20), rng.uniform(0.66, 0.74)),
+            'skin': rng.randint(140, 220), 'background': rng.randint(20, 90)}
+
+
+def draw_face(features, size, rng):
+    """ Returns a grayscale PIL image of `size` for a person `features`
+    with some random shift and noise """
+    width, height = size
+    dx, dy = rng.uniform(-0.03, 0.03, 2)
+    cx, cy = width * (0.5 + dx), height * (0.5 + dy)
+    img = Image.new('L', size, features['background'])
+    draw = ImageDraw.Draw(img)
+
+    hw, hh = features['head']
+    draw.ellipse((cx - hw * width, cy - hh * height,
+                  cx + hw * width, cy + hh * height), fill=features['skin'])
+    ex, ey = features['eyes']
+    radius = width * 0.05
+    for side in (-1, 1):
+        x, y = cx + side * ex * width, ey * height + dy * height
+        draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill=30)
+    draw.line((cx, cy - 0.05 * height, cx, cy + 0.08 * height), fill=90,
+              width=max(1, int(width * 0.03)))
+    mw, my = features['mouth']
+    draw.line((cx - mw * width, my * height + dy * height,
+               cx + mw * width, my * height + dy * height), fill=50,
+              width=max(1, int(height * 0.03)))
+
+    pixels = asarray(img, float) + rng.normal(0, NOISE, (height, width))
+    return Image.fromarray(clip(pixels, 0, 255).astype(uint8))
+
+
+def make_gallery(directory, people, images, size, seed=0):
+    """ Creates a gallery at `directory` with `people` folders holding
+    `images` faces of `size` each. Returns the features per person """
+    rng = RandomState(seed)
+    features = []
+    for person in xrange(people):
+        folder = join(directory, PERSON_FORMAT % person)
+        if not exists(folder):
+            makedirs(folder)
+        features.append(person_features(rng))
+        for idx in xrange(images):
+            draw_face(features[-1], size, rng).save(join(folder,
+                                                         IMAGE_FORMAT % idx))
+    return features
+
+
+def make_photos(directory, photos, faces, size, face_size, features=None,
+                seed=0):
+    """ Creates `photos` photos of `size` at `directory` with `faces` faces
+    of `face_size` each, drawn for people in `features` (random people by
+    default). Returns the manifest, a dict of photo name -> list of
+    ((x1, y1), (x2, y2), person) also saved as MANIFEST_NAME """
+    rng = RandomState(seed)
+    if not exists(directory):
+        makedirs(directory)
+    width, height = size
+    face_width, face_height = face_size
+    columns = max(1, width // (face_width * 2))
+
+    manifest = {}
+    for photo in xrange(photos):
+        pixels = rng.normal(110, 40, (height, width, 3))
+        img = Image.fromarray(clip(pixels, 0, 255).astype(uint8))
+        boxes = []
+        for idx in xrange(faces):
+            if features:
+                person = rng.randint(len(features))
+                face = draw_face(features[person], face_size, rng)
+            else:
+                person = None
+                face = draw_face(person_features(rng), face_size, rng)
+            # faces laid on a grid so they never overlap
+            x = (idx % columns) * face_width * 2 + face_width // 2
+            y = (idx // columns) * face_height * 2 + face_height // 2
+            if x + face_width > width or y + face_height > height:
+                break
+            img.paste(face.convert('RGB'), (x, y))
+            boxes.append(((x, y), (x + face_width, y + face_height), person))
+        name = PHOTO_FORMAT % photo
+        img.save(join(directory, name), quality=90)
+        manifest[name] = boxes
+
+    with open(join(directory, MANIFEST_NAME), 'w') as output:
+        json.dump(manifest, output)
+    return manifest
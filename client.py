@@ -0,0 +1,118 @@
+#!/usr/bin/python
+"""
+Thin client for the faces service (see service.py), takes the same
+options as faces.py but the work is done by the warm service. Only the
+standard library is imported so it starts quickly.
+"""
+import sys
+import json
+import socket
+import optparse
+import tempfile
+from os import listdir
+from os.path import abspath, join
+
+
+DEFAULT_SOCKET = join(tempfile.gettempdir(), 'faces.sock')
+LOCALHOST      = '127.0.0.1'
+
+
+class Client(object):
+    """ Faces service client, `address` is the service Unix socket path or
+    its localhost TCP port """
+    def __init__(self, address=DEFAULT_SOCKET):
+        if isinstance(address, int):
+            self.socket = socket.create_connection((LOCALHOST, address))
+        else:
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.connect(address)
+        self.stream = self.socket.makefile('rw')
+
+    def request(self, command, **values):
+        """ Sends `command` with `values` and returns the service response.
+        Raises IOError with the service message on failures """
+        values['command'] = command
+        self.stream.write(json.dumps(values) + '\n')
+        self.stream.flush()
+        line = self.stream.readline()
+        if not line:
+            raise IOError, 'Connection closed by the service'
+        response = json.loads(line)
+        if 'error' in response:
+            raise IOError, response['error']
+        return response
+
+    def recognize(self, image, faces=None, people=None, threshold=None):
+        """ Returns [(name, match, distance), ...] for people found in
+        `image`, see faces.find_people """
+        values = {'image': abspath(image)}
+        if faces:
+            values['faces'] = abspath(faces)
+        if people:
+            values['people'] = abspath(people)
+        if threshold is not None:
+            values['threshold'] = threshold
+        return [tuple(person) for person in
+                    self.request('recognize', **values)['people']]
+
+    def extract(self, image, faces):
+        """ Returns the faces found in `image` saved at `faces` """
+        return self.request('extract', image=abspath(image),
+                            faces=abspath(faces))['faces']
+
+    def detect(self, image):
+        """ Returns the faces boxes detected in `image` """
+        return self.request('detect', image=abspath(image))['boxes']
+
+    def close(self):
+        self.stream.close()
+        self.socket.close()
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('-i', '--image', dest='image')
+    parser.add_option('-f', '--faces', dest='faces')
+    parser.add_option('-t', '--threshold', type='float', default=None,
+                      dest='threshold')
+    parser.add_option('-e', '--extract', default=False, action='store_true',
+                      dest='extract')
+    parser.add_option('-d', '--extract-directory', dest='extract_src')
+    parser.add_option('-s', '--show', default=False, action='store_true',
+                      dest='show')
+    parser.add_option('-p', '--people', dest='people')
+    parser.add_option('-S', '--socket', default=DEFAULT_SOCKET, dest='socket')
+    parser.add_option('-P', '--port', type='int', default=None, dest='port')
+
+    (options, args) = parser.parse_args()
+
+    client = Client(options.port or options.socket)
+    if options.extract:
+        if not options.faces or not options.extract_src:
+            parser.print_help()
+            sys.exit(2)
+        src = options.extract_src
+        images = listdir(src)
+        if images:
+            for image in images:
+                faces = client.extract(join(src, image), options.faces)
+                print 'Faces found for "%s": %s' % (image, ', '.join(faces))
+        else:
+            print 'No faces recognised on the photo'
+    else:
+        if not options.image:
+            parser.print_help()
+            sys.exit(2)
+        people = client.recognize(options.image, options.faces,
+                                  options.people, options.threshold)
+        if people:
+            print 'People found on "%s": %s' % \
+                    (options.image,
+                     ', '.join(('\n\t%s (%s %s)' % person for person in people)))
+
+            if options.show:
+                from pyfaces.utils import merge_images
+                merge_images([options.image] + [person[1] for person in people]).show()
+        else:
+            print 'No body was recognised on the photo'
+    client.close()
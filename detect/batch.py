@@ -0,0 +1,169 @@
+#!/usr/bin/python
+"""
+Parallel face extraction over directories of photos.
+
+Photos are spread across a process pool and results are streamed back
+as they finish. At most `max_in_flight` photos are queued at a time so
+memory stays bounded no matter the directory size, and results can be
+saved as JSON lines that a later run uses to skip finished photos.
+Photos with no result `timeout` seconds after being queued (their
+worker died, e.g. OpenCV crashed on a corrupt file, or hung) are
+reported as errors, failed photos are retried by later runs.
+"""
+import sys
+import json
+import optparse
+import Queue
+from time import time
+
+from os import listdir
+from os.path import exists, join
+from multiprocessing import Pool, cpu_count
+
+from extract import extract
+
+
+IN_FLIGHT_PER_JOB = 2
+TASK_TIMEOUT      = 600 # seconds from queuing a photo to its result
+
+
+def _extract_one(image, directory):
+    """ Pool worker, returns extract result for `image` as a dict """
+    try:
+        return {'image': image, 'faces': extract(image, directory)}
+    except Exception, e:
+        return {'image': image, 'error': str(e)}
+
+
+def extract_all(images, directory, jobs=None, max_in_flight=None,
+                timeout=None):
+    """ Extracts faces from `images` paths to `directory` using `jobs`
+    processes (defaults to the number of cores).
+
+    Parameters:
+        @images: iterable of image paths, consumed lazily
+        @directory: directory to save faces at
+        @jobs: number of worker processes
+        @max_in_flight: max number of photos queued or being processed
+                        (defaults to IN_FLIGHT_PER_JOB per job)
+        @timeout: seconds from queuing a photo until it's reported as
+                  lost (defaults to TASK_TIMEOUT)
+
+    Returns:
+        Generator of {'image': path, 'faces': [names]} dicts (or
+        {'image': path, 'error': message}) in completion order
+    """
+    jobs = jobs or cpu_count()
+    max_in_flight = max_in_flight or jobs * IN_FLIGHT_PER_JOB
+    timeout = timeout or TASK_TIMEOUT
+    results = Queue.Queue()
+    pool = Pool(jobs)
+    pending = {} # task number -> (image, deadline)
+    try:
+        for number, image in enumerate(images):
+            while len(pending) >= max_in_flight:
+                for result in _wait(results, pending, timeout):
+                    yield result
+            pool.apply_async(_extract_one, (image, directory),
+                             callback=lambda result, number=number:
+                                            results.put((number, result)))
+            pending[number] = (image, time() + timeout)
+        while pending:
+            for result in _wait(results, pending, timeout):
+                yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _wait(results, pending, timeout):
+    """ Waits for the result of a `pending` task, returns the results
+    that arrived, or an error per task past its deadline. Results of
+    tasks already reported as lost are dropped """
+    deadline = min(deadline for image, deadline in pending.itervalues())
+    try:
+        number, result = results.get(True, max(deadline - time(), 0))
+    except Queue.Empty:
+        now = time()
+        return [{'image': pending.pop(number)[0],
+                 'error': 'no result after %ss, worker died or hung' %
+                                timeout}
+                    for number, (image, deadline) in pending.items()
+                        if deadline <= now]
+    if pending.pop(number, None) is None:
+        return []
+    return [result]
+
+
+def extract_directory(src, directory, jobs=None, max_in_flight=None,
+                      done=None, timeout=None):
+    """ Extracts faces from every photo at `src` to `directory` skipping
+    photos in `done`, see extract_all """
+    done = done or set()
+    images = (join(src, name) for name in sorted(listdir(src)))
+    return extract_all((image for image in images if image not in done),
+                       directory, jobs, max_in_flight, timeout)
+
+
+def processed(output):
+    """ Returns the set of images extracted at `output` JSON lines file,
+    images with an error are left out so they're retried. A truncated
+    last line (interrupted run) is ignored """
+    done = set()
+    if exists(output):
+        with open(output) as results:
+            for line in results:
+                try:
+                    result = json.loads(line)
+                    if 'error' not in result: # listed paths are bytes
+                        done.add(result['image'].encode('utf-8'))
+                except (ValueError, KeyError, TypeError):
+                    pass
+    return done
+
+
+def write_results(results, output):
+    """ Appends `results` to `output` JSON lines file ('-' for stdout)
+    as they come, yielding them back """
+    handle = sys.stdout if output == '-' else open(output, 'a+')
+    try:
+        if handle is not sys.stdout:
+            handle.seek(0, 2)
+            if handle.tell():
+                handle.seek(-1, 2)
+                if handle.read(1) != '\n': # interrupted run, end its line
+                    handle.write('\n')
+        for result in results:
+            handle.write(json.dumps(result) + '\n')
+            handle.flush()
+            yield result
+    finally:
+        if handle is not sys.stdout:
+            handle.close()
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('-s', '--source', dest='source')
+    parser.add_option('-d', '--directory', dest='directory')
+    parser.add_option('-j', '--jobs', type='int', default=None, dest='jobs')
+    parser.add_option('-o', '--output', default='-', dest='output')
+    parser.add_option('-r', '--resume', default=False, action='store_true',
+                      dest='resume')
+    parser.add_option('-t', '--timeout', type='float', default=TASK_TIMEOUT,
+                      dest='timeout', help='seconds a photo may take before '
+                                           'it is reported as lost')
+    (options, args) = parser.parse_args()
+
+    if not options.source or not options.directory:
+        parser.print_help()
+        sys.exit(2)
+
+    done = processed(options.output) if options.resume and \
+                                        options.output != '-' else None
+    results = extract_directory(options.source, options.directory,
+                                options.jobs, done=done,
+                                timeout=options.timeout)
+    for result in write_results(results, options.output):
+        pass
@@ -5,7 +5,9 @@ import Image
 
 from os.path import join, split, exists, isdir, isfile 
 
-from facedetect import detect
+from numpy import asarray
+
+from facedetect import detect, STATS
 
 
 DEFAULT_EXTENSION  = 'jpg'
@@ -13,25 +15,64 @@ OUTPUT_NAME_FORMAT = '%s_%sx%s.' + DEFAULT_EXTENSION
 
 
 def extract(image, directory):
-    def crop(box):
-        if box:
-            (x1, y1), (x2, y2) = box
-            name = OUTPUT_NAME_FORMAT % \
-                        ('.'.join(split(image)[-1].split('.')[:-1]),
-                         x2 - x1, y2 - y1)
-            image_name = join(directory, name)
-            result = open(image_name, 'w')
-            Image.open(image).crop((x1, y1, x2, y2)).save(result)
-            result.close()
-            return image_name
-
+    """ Saves faces detected on `image` at `directory`, returns the list
+    of saved faces file names """
     if not exists(directory) or not isdir(directory):
         raise IOError, '"%s" is not a directory' % directory
+    return save_faces(image, extract_faces(image), directory)
+
+
+def extract_faces(image, as_array=False):
+    """ Detects faces on `image`, nothing is written to disk. Image files
+    are detected on a reduced decode (see facedetect.open_reduced) and
+    decoded at full resolution only to crop the faces found.
+
+    Parameters:
+        @image: image path, open image file or decoded PIL image
+        @as_array: return faces as grayscale numpy arrays instead of PIL
+                   images
+
+    Returns:
+        [(box, face), ...] detected boxes and cropped faces
+    """
+    encoded = isinstance(image, basestring) or hasattr(image, 'read')
+    if isinstance(image, basestring):
+        if not exists(image) or not isfile(image):
+            raise IOError, '"%s" does not exists or is not an image' % image
+    elif not encoded:
+        with STATS.timer('extract.decode'):
+            image.load()
+
+    faces = []
+    boxes = detect(image)
+    if boxes and encoded:
+        with STATS.timer('extract.decode'):
+            if hasattr(image, 'seek'):
+                image.seek(0)
+            image = Image.open(image)
+            image.load()
+    with STATS.timer('extract.crop'):
+        for box in boxes:
+            if box:
+                (x1, y1), (x2, y2) = box
+                face = image.crop((x1, y1, x2, y2))
+                faces.append((box, asarray(face.convert('L')) if as_array
+                                                              else face))
+    return faces
 
-    if not exists(image) or not isfile(image):
-        raise IOError, '"%s" does not exists or is not an image' % image
 
-    return filter(None, map(crop, detect(image)))
+def save_faces(image, faces, directory):
+    """ Saves `faces` (as returned by extract_faces) cropped from `image`
+    path at `directory`, returns the list of file names """
+    names = []
+    for ((x1, y1), (x2, y2)), face in faces:
+        name = OUTPUT_NAME_FORMAT % \
+                    ('.'.join(split(image)[-1].split('.')[:-1]),
+                     x2 - x1, y2 - y1)
+        image_name = join(directory, name)
+        face.save(image_name)
+        names.append(image_name)
+    return names
 
 
 if __name__ == '__main__':
@@ -1,114 +1,319 @@
-import Image, tempfile, math
-
+import sys, Image, threading
+from itertools import groupby
+from multiprocessing.pool import ThreadPool
 from os.path import abspath, dirname, join
 
+from numpy import array, arange, cos, sin, radians, maximum, minimum, \
+                  ones, empty
+
+from opencv.adaptors import PIL2Ipl
 from opencv.highgui import cvCreateFileCapture, cvQueryFrame
 from opencv.cv import cvClearMemStorage, cvCopy, cvCreateImage, cvCvtColor, \
                       cvEqualizeHist, cvHaarDetectObjects, \
                       cvLoadHaarClassifierCascade, cvResize, cvRound, cvSize, \
                       CV_HAAR_DO_CANNY_PRUNING, CV_INTER_LINEAR, CV_BGR2GRAY, \
-                      IPL_DEPTH_8U, cvCreateMemStorage
+                      cvCreateMemStorage
+
+try:
+    from pyfaces.stats import STATS
+except ImportError: # run as a script, pyfaces is a sibling package
+    sys.path.append(dirname(dirname(abspath(__file__))))
+    from pyfaces.stats import STATS
+from pyfaces.memo import MEMO, content_key, parameters_key
 
 
 CASCADES_DIR   = dirname(abspath(__file__))
 CASCADES_NAMES = ['haarcascade_frontalface_alt_tree.xml']
 CASCADES = [ join(CASCADES_DIR, name) for name in CASCADES_NAMES ]
 
-MIN_SIZE             = cvSize(100, 100)
+# Faces smaller than MIN_FACE_SIZE pixels are ignored, images are
+# reduced (at least IMAGE_SCALE times) so they're WORK_FACE_SIZE pixels
+# when the cascades run. JPEG files are decoded already reduced
+MIN_FACE_SIZE        = 130
+WORK_FACE_SIZE       = 40
 IMAGE_SCALE          = 1.3
+REDUCED_DECODE       = True
 MIN_NEIGHBORS        = 3
 HAAR_SCALE           = 1.3
 HAAR_FLAGS           = CV_HAAR_DO_CANNY_PRUNING
 DEFAULT_ROTATE_ANGLE = 45
+ROTATE_ANGLES        = (-DEFAULT_ROTATE_ANGLE, DEFAULT_ROTATE_ANGLE)
+STOP_ON_FIRST_HIT    = False
+# boxes overlapping a bigger one by more than this intersection over
+# union are the same face, 0 keeps every box
+NMS_THRESHOLD        = 0.3
+ROTATE_WORKERS       = 4
 COPY_DEPTH           = 8
 COPY_CHANNELS        = 1
-STORAGE              = cvCreateMemStorage(0)
+
+# OpenCV scales cascades and writes results into the storage while
+# detecting, so cascades, storage and work buffers are kept per thread
+_LOCAL = threading.local()
+_POOL  = []
+_POOL_LOCK = threading.Lock()
+
+
+def _cascades():
+    """ Returns the loaded CASCADES for the current thread, each cascade
+    file is parsed only once per thread """
+    cache = getattr(_LOCAL, 'cascades', None)
+    if cache is None:
+        cache = _LOCAL.cascades = {}
+    cascades = []
+    for haar_file in CASCADES:
+        if haar_file not in cache:
+            # the OpenCV API says this function is obsolete, but we can't
+            # cast the output of cvLoad to a HaarClassifierCascade, so use
+            # this anyways the size parameter is ignored
+            cache[haar_file] = cvLoadHaarClassifierCascade(haar_file,
+                                                           cvSize(1, 1))
+        if cache[haar_file]:
+            cascades.append(cache[haar_file])
+    return cascades
+
+
+def _storage():
+    """ Returns the current thread memory storage, cleared """
+    storage = getattr(_LOCAL, 'storage', None)
+    if storage is None:
+        storage = _LOCAL.storage = cvCreateMemStorage(0)
+    cvClearMemStorage(storage)
+    return storage
+
+
+def _buffer(name, size, channels=COPY_CHANNELS):
+    """ Returns the current thread image buffer `name` of `size`, the
+    buffer is reused while frames keep the same size """
+    buffers = getattr(_LOCAL, 'buffers', None)
+    if buffers is None:
+        buffers = _LOCAL.buffers = {}
+    key = (size, channels)
+    if name not in buffers or buffers[name][0] != key:
+        buffers[name] = (key, cvCreateImage(size, COPY_DEPTH, channels))
+    return buffers[name][1]
 
  
-def _detect(image):
+def working_scale():
+    """ Returns how many times images are reduced before detecting """
+    return max(IMAGE_SCALE, float(MIN_FACE_SIZE) / WORK_FACE_SIZE)
+
+
+def open_reduced(image):
+    """ Opens `image` path or file decoding it reduced towards
+    working_scale if it's a JPEG file (see PIL draft mode). Returns (img,
+    factor) with the grayscale PIL image and how many times it was
+    reduced, or (None, 1) if `image` can't be decoded reduced """
+    if not REDUCED_DECODE:
+        return None, 1.0
+    with STATS.timer('detect.decode'):
+        try:
+            img = Image.open(image)
+        except IOError: # let OpenCV try
+            return None, 1.0
+        if img.format != 'JPEG':
+            return None, 1.0
+        width, height = img.size
+        scale = working_scale()
+        img.draft('L', (int(width / scale), int(height / scale)))
+        img = img.convert('L')
+    return img, float(width) / img.size[0]
+
+
+def _detect(image, factor=1.0):
     """ Detects faces on `image`
     Parameters:
-        @image: image file path
+        @image: image file path or decoded PIL image
+        @factor: times `image` was reduced from the original image
 
     Returns:
         [((x1, y1), (x2, y2)), ...] List of coordenates for top-left
-                                    and bottom-right corner
+                                    and bottom-right corner, on the
+                                    original image
     """
-    # the OpenCV API says this function is obsolete, but we can't
-    # cast the output of cvLoad to a HaarClassifierCascade, so use
-    # this anyways the size parameter is ignored
-    capture = cvCreateFileCapture(image) 
+    if not isinstance(image, basestring):
+        # already decoded, hand the grayscale pixels straight to OpenCV
+        with STATS.timer('detect.convert'):
+            gray = PIL2Ipl(image.convert('L'))
+        return _detect_gray(gray, factor)
 
-    if not capture:
-        return []
+    with STATS.timer('detect.decode'):
+        capture = cvCreateFileCapture(image) 
 
-    frame = cvQueryFrame(capture)
-    if not frame:
-        return []
+        if not capture:
+            return []
 
-    img = cvCreateImage(cvSize(frame.width, frame.height),
-                        IPL_DEPTH_8U, frame.nChannels)
-    cvCopy(frame, img)
+        frame = cvQueryFrame(capture)
+        if not frame:
+            return []
 
-    # allocate temporary images
-    gray          = cvCreateImage((img.width, img.height),
-                                  COPY_DEPTH, COPY_CHANNELS)
-    width, height = (cvRound(img.width / IMAGE_SCALE),
-                     cvRound(img.height / IMAGE_SCALE))
-    small_img     = cvCreateImage((width, height), COPY_DEPTH, COPY_CHANNELS)
+        img = _buffer('frame', cvSize(frame.width, frame.height),
+                      frame.nChannels)
+        cvCopy(frame, img)
 
-    # convert color input image to grayscale
-    cvCvtColor(img, gray, CV_BGR2GRAY)
+        # convert color input image to grayscale
+        gray = _buffer('gray', cvSize(img.width, img.height))
+        cvCvtColor(img, gray, CV_BGR2GRAY)
+    return _detect_gray(gray)
+
+
+def _detect_gray(gray, factor=1.0):
+    """ Detects faces on `gray` grayscale IplImage reduced `factor` times
+    from the original image, returns coordinates as _detect """
+    # reduce what's left to working scale
+    scale = max(1.0, working_scale() / factor)
+    min_size = max(1, cvRound(MIN_FACE_SIZE / (factor * scale)))
+    width, height = (cvRound(gray.width / scale),
+                     cvRound(gray.height / scale))
+    small_img     = _buffer('small', cvSize(width, height))
 
     # scale input image for faster processing
     cvResize(gray, small_img, CV_INTER_LINEAR)
     cvEqualizeHist(small_img, small_img)
-    cvClearMemStorage(STORAGE)
+    storage = _storage()
 
-    coords = []
-    for haar_file in CASCADES:
-        cascade = cvLoadHaarClassifierCascade(haar_file, cvSize(1, 1))
-        if cascade:
-            faces = cvHaarDetectObjects(small_img, cascade, STORAGE, HAAR_SCALE,
-                                        MIN_NEIGHBORS, HAAR_FLAGS, MIN_SIZE) or []
-            for face_rect in faces:
-                # the input to cvHaarDetectObjects was resized, so scale the 
-                # bounding box of each face and convert it to two CvPoints
-                x, y = face_rect.x, face_rect.y
-                pt1 = (int(x * IMAGE_SCALE), int(y * IMAGE_SCALE))
-                pt2 = (int((x + face_rect.width) * IMAGE_SCALE),
-                       int((y + face_rect.height) * IMAGE_SCALE))
-                coords.append((pt1, pt2))
+    coords, scale = [], scale * factor # working to original coordinates
+    for cascade in _cascades():
+        with STATS.timer('detect.cascade'):
+            faces = cvHaarDetectObjects(small_img, cascade, storage,
+                                        HAAR_SCALE, MIN_NEIGHBORS, HAAR_FLAGS,
+                                        cvSize(min_size, min_size)) or []
+        for face_rect in faces:
+            # the input to cvHaarDetectObjects was resized, so scale the 
+            # bounding box of each face and convert it to two CvPoints
+            x, y = face_rect.x, face_rect.y
+            pt1 = (int(x * scale), int(y * scale))
+            pt2 = (int((x + face_rect.width) * scale),
+                   int((y + face_rect.height) * scale))
+            coords.append((pt1, pt2))
     return coords
 
 
-def detect(image):
+def detect(image, angles=None, first_hit=None):
     """ Aims to detect faces in `image`. If no faces are detected,
-    the image is rotated DEFAULT_ROTATE_ANGLE left and right trying to
-    get potentially inclined faces.
+    the image is rotated by `angles` (ROTATE_ANGLES by default,
+    DEFAULT_ROTATE_ANGLE left and right) trying to get potentially
+    inclined faces.
 
     Parameters:
-        @image: image path
+        @image: image path, open image file or decoded PIL image
+        @angles: rotation angles to try if no faces are detected
+        @first_hit: stop trying wider angles once an angle finds faces
+                    (defaults to STOP_ON_FIRST_HIT)
 
     Returns:
         [((x1, y1), (x2, y2)), ...] List of coordenates for top-left
                                     and bottom-right corner
 
     Rotated coordinates are rotated back to original image position.
+    JPEG files are decoded reduced (see open_reduced), coordinates are
+    on the full resolution image anyways. The same face found by several
+    cascades or angles is returned once (see suppress). Coordinates are
+    cached at MEMO (if enabled) under the image contents and detection
+    parameters.
     """
-    coords = _detect(image) or []
+    if first_hit is None:
+        first_hit = STOP_ON_FIRST_HIT
+    angles = angles or ROTATE_ANGLES
+    if MEMO.enabled:
+        namespace, key = _parameters_key(angles, first_hit), content_key(image)
+        coords = MEMO.get(namespace, key)
+        if coords is None:
+            coords = _detect_image(image, angles, first_hit)
+            MEMO.put(namespace, key, coords)
+        return [tuple(map(tuple, box)) for box in coords]
+    return _detect_image(image, angles, first_hit)
+
+
+def _parameters_key(angles, first_hit):
+    """ Returns the MEMO namespace for detections with current settings """
+    return 'detect-' + parameters_key(CASCADES, MIN_FACE_SIZE, WORK_FACE_SIZE,
+                                      IMAGE_SCALE, REDUCED_DECODE,
+                                      MIN_NEIGHBORS, HAAR_SCALE, HAAR_FLAGS,
+                                      tuple(angles), first_hit, NMS_THRESHOLD)
+
+
+def _detect_image(image, angles, first_hit):
+    """ Detects faces on `image`, see detect """
+    factor = 1.0
+    if isinstance(image, basestring) or hasattr(image, 'read'):
+        reduced, factor = open_reduced(image)
+        if reduced is not None:
+            image = reduced
+        elif hasattr(image, 'read'): # OpenCV only reads paths
+            image.seek(0)
+            image = Image.open(image)
+    coords = _detect(image, factor) or []
 
     if not coords:
-        img = Image.open(image)
+        STATS.incr('detect.rotation_fallbacks')
+        img = image if not isinstance(image, basestring) else Image.open(image)
+        with STATS.timer('detect.rotation'):
+            coords = _detect_rotated(img, angles, first_hit, factor)
+    coords = suppress(coords)
+    STATS.incr('detect.faces', len(coords))
+    return coords
+
+
+def suppress(boxes, threshold=None):
+    """ Non maximum suppression, removes from `boxes` those overlapping a
+    bigger box by more than `threshold` intersection over union
+    (NMS_THRESHOLD by default). Cascades give no detection scores, so
+    bigger boxes win. Kept boxes are returned in the same order. """
+    if threshold is None:
+        threshold = NMS_THRESHOLD
+    if len(boxes) < 2 or not threshold:
+        return boxes
+    x1, y1, x2, y2 = array(boxes, float).reshape(-1, 4).transpose()
+    areas = (x2 - x1) * (y2 - y1)
+    overlap = (minimum(x2[:,None], x2) - maximum(x1[:,None], x1)).clip(0) * \
+              (minimum(y2[:,None], y2) - maximum(y1[:,None], y1)).clip(0)
+    iou = overlap / maximum(areas[:,None] + areas - overlap, 1e-9)
+
+    order = (-areas).argsort(kind='mergesort')
+    rank = empty(len(boxes), int)
+    rank[order] = arange(len(boxes))
+    keep = ones(len(boxes), bool)
+    for i in order:
+        if keep[i]:
+            keep &= ~((iou[i] > threshold) & (rank > rank[i]))
+    STATS.incr('detect.suppressed', len(boxes) - int(keep.sum()))
+    return [box for box, kept in zip(boxes, keep) if kept]
+
+
+def _detect_rotated(img, angles, first_hit, factor=1.0):
+    """ Detects faces on `img` PIL image rotated by every angle in
+    `angles`, rotations are done in memory and detected concurrently.
+    If `first_hit` is set, angles are tried in waves of the same
+    magnitude (-15 and 15, then -30 and 30, ...) until one finds faces.
+    `img` was reduced `factor` times from the original image.
+    """
+    def detect_angle(degree):
+        return rotate_boxes(-1 * degree, _detect(img.rotate(degree), factor))
+
+    img.load()
+    if first_hit:
+        waves = [list(wave) for magnitude, wave in
+                    groupby(sorted(angles, key=abs), key=abs)]
+    else:
+        waves = [list(angles)]
 
-        for degree in (-DEFAULT_ROTATE_ANGLE, DEFAULT_ROTATE_ANGLE):
-            tmp = tempfile.NamedTemporaryFile(suffix='.' + image.split('.')[-1])
-            img.rotate(degree).save(tmp)
-            coords += [rotate(-1 * degree, box) for box in _detect(tmp.name)]
-            tmp.close()
+    coords = []
+    for wave in waves:
+        for boxes in _pool().map(detect_angle, wave):
+            coords += boxes
+        if coords and first_hit:
+            break
     return coords
 
 
+def _pool():
+    """ Returns the process wide pool for rotated detections """
+    with _POOL_LOCK:
+        if not _POOL:
+            _POOL.append(ThreadPool(ROTATE_WORKERS))
+    return _POOL[0]
+
+
 def rotate(degree, box):
     """ Rotates `degree` the coords on `box` using the `box`
     center as the rotate axis.
@@ -121,18 +326,36 @@ def rotate(degree, box):
         [(x1, y1), (x2, y2)]: Rotated top-left and bottom-right
                               coordinats
     """
-    (x1, y1), (x2, y2) = box
-    orig_x, orig_y = int((x2 - x1)/2), int((y2 - y1)/2)
+    return list(rotate_boxes(degree, [box])[0])
+
+
+def rotate_boxes(degree, boxes):
+    """ Rotates `degree` every box in `boxes` as rotate does, all at once.
+
+    Parameters:
+        @degree: Degrees to rotate back the boxes
+        @boxes: List of top-left and bottom-right coordinates tuples
+
+    Returns:
+        [((x1, y1), (x2, y2)), ...] Rotated top-left and bottom-right
+                                    coordinates
+    """
+    if not len(boxes):
+        return []
+    x1, y1, x2, y2 = array(boxes).reshape(-1, 4).transpose()
+    orig_x, orig_y = (x2 - x1) // 2, (y2 - y1) // 2
 
     x0 = x1 - orig_x
     y0 = y1 - orig_y
 
-    rad = math.radians(degree) # conver to radians
-    cos_rad = math.cos(rad)
-    sin_rad = math.sin(rad)
+    rad = radians(degree) # conver to radians
+    cos_rad = cos(rad)
+    sin_rad = sin(rad)
 
-    new_x = int((x0 * cos_rad) - (y0 * sin_rad))
-    new_y = int((x0 * sin_rad) + (y0 * cos_rad))
+    new_x = ((x0 * cos_rad) - (y0 * sin_rad)).astype(int) + orig_x
+    new_y = ((x0 * sin_rad) + (y0 * cos_rad)).astype(int) + orig_y
 
-    return [(new_x + orig_x, new_y + orig_y),
-            (new_x + orig_x + x2 - x1, new_y + orig_y + y2 - y1)]
+    return [((left, top), (left + width, top + height))
+                for left, top, width, height in
+                    zip(new_x.tolist(), new_y.tolist(),
+                        (x2 - x1).tolist(), (y2 - y1).tolist())]
@@ -0,0 +1,201 @@
+#!/usr/bin/python
+"""
+Faces detection over video files.
+
+Running the Haar cascades on every frame is too slow for real time, so
+they only run every DETECT_EVERY frames. In between, faces are followed
+by matching the template taken when they were detected around their
+last position, on a grayscale copy of the frame reduced TRACK_SCALE
+times. If any face can't be matched with at least MIN_CONFIDENCE
+normalized correlation (it moved too fast, turned away or left),
+cascades run again on that frame. Rotated detection isn't tried on
+videos.
+"""
+import sys
+import time
+import optparse
+
+from numpy import asarray, einsum, float64, sqrt, zeros
+from numpy.lib.stride_tricks import as_strided
+
+from opencv.adaptors import Ipl2NumPy, Ipl2PIL
+from opencv.highgui import cvCreateFileCapture, cvQueryFrame
+from opencv.cv import cvCvtColor, cvResize, cvRound, cvSize, CV_BGR2GRAY, \
+                      CV_INTER_AREA
+
+from facedetect import _buffer, _detect_gray, suppress, STATS
+
+
+DETECT_EVERY   = 10
+MIN_CONFIDENCE = 0.6
+TRACK_SCALE    = 4
+SEARCH_MARGIN  = 0.25 # of the face size, in every direction
+MIN_TEMPLATE   = 4
+
+
+class Track(object):
+    """ A face followed across frames. `origin` is the box detected on
+    the full frame, `start` and `box` the first and current boxes on the
+    tracking image """
+    def __init__(self, template, box, origin):
+        template = template - template.mean()
+        norm = sqrt((template ** 2).sum())
+        self.template = template / norm if norm else template
+        self.start = self.box = box
+        self.origin = origin
+        self.confidence = 1.0
+
+    def frame_box(self):
+        """ Returns the current box as full frame coordinates """
+        dx = (self.box[0] - self.start[0]) * TRACK_SCALE
+        dy = (self.box[1] - self.start[1]) * TRACK_SCALE
+        (x1, y1), (x2, y2) = self.origin
+        return ((x1 + dx, y1 + dy), (x2 + dx, y2 + dy))
+
+
+def track_faces(source, every=DETECT_EVERY, min_confidence=MIN_CONFIDENCE):
+    """ Detects faces on every frame of `source` video file.
+
+    Parameters:
+        @source: video file path
+        @every: run the cascades at least every `every` frames
+        @min_confidence: run the cascades if a face is followed with less
+                         normalized correlation than this
+
+    Yields:
+        (index, frame, boxes, detected) per frame, `frame` is the decoded
+        IplImage (only valid until the next frame), `boxes` the faces
+        coordinates as facedetect.detect returns them, kept in the same
+        order until the next detection (faces too small to follow stay at
+        their detected box), and `detected` is True if the cascades ran
+        on this frame.
+    """
+    capture = cvCreateFileCapture(source)
+    if not capture:
+        raise IOError, '"%s" can\'t be opened as a video' % source
+
+    boxes, tracks, index = [], [], 0
+    while True:
+        frame = cvQueryFrame(capture)
+        if not frame:
+            break
+        with STATS.timer('video.decode'):
+            gray = _buffer('video_gray', cvSize(frame.width, frame.height))
+            cvCvtColor(frame, gray, CV_BGR2GRAY)
+            small = _buffer('video_track',
+                            cvSize(cvRound(frame.width / TRACK_SCALE),
+                                   cvRound(frame.height / TRACK_SCALE)))
+            cvResize(gray, small, CV_INTER_AREA)
+            pixels = asarray(Ipl2NumPy(small), float64)
+            if pixels.ndim > 2:
+                pixels = pixels[:,:,0]
+
+        detected = index % every == 0
+        if not detected:
+            with STATS.timer('video.track'):
+                for track in tracks:
+                    if track:
+                        follow(track, pixels)
+            detected = any(track.confidence < min_confidence
+                                for track in tracks if track)
+            boxes = [track.frame_box() if track else box
+                        for box, track in zip(boxes, tracks)]
+        if detected:
+            STATS.incr('video.detections')
+            boxes = suppress(_detect_gray(gray))
+            # faces too small to follow keep their box (and position in
+            # boxes) until next detection, a track per box
+            tracks = [start_track(pixels, box) for box in boxes]
+        STATS.incr('video.frames')
+        yield index, frame, boxes, detected
+        index += 1
+
+
+def detect_video(source, every=DETECT_EVERY, min_confidence=MIN_CONFIDENCE):
+    """ Yields (index, boxes) for every frame of `source` video file, see
+    track_faces """
+    for index, frame, boxes, detected in track_faces(source, every,
+                                                     min_confidence):
+        yield index, boxes
+
+
+def crop_faces(frame, boxes):
+    """ Returns `boxes` cropped from `frame` IplImage as PIL images """
+    image = Ipl2PIL(frame)
+    return [image.crop((x1, y1, x2, y2)) for (x1, y1), (x2, y2) in boxes]
+
+
+def start_track(pixels, box):
+    """ Returns a Track for `box` detected on the full frame, None if it's
+    too small to be followed on `pixels` tracking image """
+    (x1, y1), (x2, y2) = box
+    x1, y1 = max(0, x1 // TRACK_SCALE), max(0, y1 // TRACK_SCALE)
+    x2 = min(pixels.shape[1], x2 // TRACK_SCALE)
+    y2 = min(pixels.shape[0], y2 // TRACK_SCALE)
+    if x2 - x1 < MIN_TEMPLATE or y2 - y1 < MIN_TEMPLATE:
+        return None
+    return Track(pixels[y1:y2, x1:x2], (x1, y1, x2, y2), box)
+
+
+def follow(track, pixels):
+    """ Moves `track` to the best normalized correlation of its template
+    on `pixels` around its last position """
+    x1, y1, x2, y2 = track.box
+    height, width = track.template.shape
+    margin_x = max(1, int(width * SEARCH_MARGIN))
+    margin_y = max(1, int(height * SEARCH_MARGIN))
+    left, top = max(0, x1 - margin_x), max(0, y1 - margin_y)
+    right = min(pixels.shape[1], x2 + margin_x)
+    bottom = min(pixels.shape[0], y2 + margin_y)
+    area = pixels[top:bottom, left:right]
+    rows, cols = area.shape[0] - height + 1, area.shape[1] - width + 1
+    if rows < 1 or cols < 1: # left the frame
+        track.confidence = 0.0
+        return
+
+    # windows sums from integral images, every candidate window as a
+    # (rows, cols, height, width) view for the products
+    sums = window_sums(area, height, width)
+    squares = window_sums(area ** 2, height, width)
+    norms = sqrt((squares - sums ** 2 / (height * width)).clip(0))
+    windows = as_strided(area, (rows, cols, height, width),
+                         area.strides + area.strides)
+    # template is zero mean so the window mean doesn't change the product
+    scores = einsum('ijkl,kl->ij', windows, track.template) / \
+                norms.clip(1e-9)
+    row, col = divmod(int(scores.argmax()), cols)
+    track.confidence = float(scores[row, col])
+    track.box = (left + col, top + row, left + col + width,
+                 top + row + height)
+
+
+def window_sums(area, height, width):
+    """ Returns the sum of every `height` x `width` window in `area` """
+    integral = zeros((area.shape[0] + 1, area.shape[1] + 1))
+    integral[1:,1:] = area.cumsum(axis=0).cumsum(axis=1)
+    return integral[height:,width:] - integral[:-height,width:] - \
+           integral[height:,:-width] + integral[:-height,:-width]
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('-v', '--video', dest='video')
+    parser.add_option('-n', '--every', type='int', default=DETECT_EVERY,
+                      dest='every')
+    parser.add_option('-m', '--min-confidence', type='float',
+                      default=MIN_CONFIDENCE, dest='min_confidence')
+    (options, args) = parser.parse_args()
+
+    if not options.video:
+        parser.print_help()
+        sys.exit(2)
+
+    start, frames = time.time(), 0
+    for index, boxes in detect_video(options.video, options.every,
+                                     options.min_confidence):
+        frames += 1
+        if boxes:
+            print '%d: %s' % (index, boxes)
+    elapsed = time.time() - start
+    print >> sys.stderr, '%d frames in %.2fs (%.1f fps)' % \
+                            (frames, elapsed, frames / (elapsed or 1))
@@ -2,17 +2,18 @@
 """
 Who is an integration between OpenCV face detection/extraction
 and pyfaces face recognition (eigenfaces method).
+
+OpenCV, PIL and numpy are imported when first needed, so importing this
+module or asking for --help doesn't load them.
 """
 
 import sys
 import optparse
 from os import listdir
-from os.path import abspath, dirname, join, isdir, basename
+from os.path import abspath, dirname, join, basename
 
-from detect.extract import extract
-from pyfaces.pyfaces import PyFaces, THRESHOLD
-from pyfaces.eigenfaces import parse_folder
-from pyfaces.utils import merge_images
+from pyfaces.pyfaces import THRESHOLD
+from pyfaces.stats import STATS
 
 
 PEOPLE           = 'people'
@@ -31,49 +32,162 @@ def reduce_result(matches):
     return values
             
 
-def find_people(image, faces, people, threshold):
+def find_people(image, faces, people, threshold, bundle=None):
     """ Finds people in `image` using faces from `faces` that
-    souits the `threshold` limit
+    souits the `threshold` limit. `people` is a gallery directory with
+    a folder per person, matched all at once in a single eigenspace, or
+    a person at a time if their faces differ in size.
+    `image` is decoded once and faces are matched in memory, they are
+    saved at `faces` directory only if given. An already loaded gallery
+    `bundle` for `people` can be given to skip the cache checks.
+    Stages timings and counters are recorded at STATS if enabled.
+    """
+    from detect.extract import extract_faces, save_faces
+    from pyfaces.pyfaces import PyFaces
+    from pyfaces.eigenfaces import match_bundle
+
+    with STATS.timer('faces.extract'):
+        crops = extract_faces(image)
+    if faces:
+        with STATS.timer('faces.save'):
+            save_faces(image, crops, faces)
+    crops = [face for box, face in crops]
+    with STATS.timer('faces.match'):
+        if bundle is None:
+            candidates = PyFaces(crops, people, threshold=threshold).who()
+        else:
+            candidates = match_bundle(bundle, crops, threshold)
+    return reduce_result([(person, match, dist)
+                            for dist, match, person in candidates if match])
+
+
+def find_people_video(video, people, threshold, every=None, bundle=None):
+    """ Finds people on every frame of `video` file. Faces are matched
+    against `people` gallery (or its already loaded `bundle`) only when
+    they're detected, every `every` frames at least (defaults to
+    DETECT_EVERY), tracked faces keep their match, see
+    detect.video.track_faces.
+
+    Yields:
+        (index, [(box, (name, match, dist)), ...]) per frame, name,
+        match and dist are None for faces not recognised
     """
+    from detect.video import track_faces, crop_faces, DETECT_EVERY
+    from pyfaces.eigenfaces import match_bundle, get_gallery_bundle
+
+    if bundle is None:
+        bundle = get_gallery_bundle(people)
     matches = []
-    for face in extract(image, faces):
-        for person in parse_folder(people, lambda name: isdir(name)):
-            dist, match = PyFaces(face, person, threshold=threshold).match()
-            if match:
-                matches.append((basename(person), match, dist))
-    return reduce_result(matches)
+    for index, frame, boxes, detected in track_faces(video,
+                                                     every or DETECT_EVERY):
+        if detected:
+            matches = [(person, match, dist) for dist, match, person in
+                            match_bundle(bundle, crop_faces(frame, boxes),
+                                         threshold)]
+        yield index, zip(boxes, matches)
 
 
 if __name__ == '__main__':
     parser = optparse.OptionParser()
     parser.add_option('-i', '--image', dest='image')
     parser.add_option('-f', '--faces', dest='faces')
-    parser.add_option('-t', '--threshold', default=THRESHOLD, dest='threshold')
+    parser.add_option('-t', '--threshold', type='float', default=THRESHOLD,
+                      dest='threshold')
     parser.add_option('-e', '--extract', default=False, action='store_true',
                       dest='extract')
     parser.add_option('-d', '--extract-directory', dest='extract_src')
+    parser.add_option('-v', '--video', dest='video')
+    parser.add_option('-n', '--every', type='int', default=None,
+                      dest='every', help='detect faces on video every N '
+                                         'frames, track them in between')
     parser.add_option('-s', '--show', default=False, action='store_true',
                       dest='show')
     parser.add_option('-p', '--people', default=PEOPLE_DIRECTORY,
                       dest='people')
+    parser.add_option('-c', '--cache-dir', default=None, dest='cache_dir')
+    parser.add_option('-j', '--jobs', type='int', default=None, dest='jobs')
+    parser.add_option('-o', '--output', dest='output')
+    parser.add_option('-r', '--resume', default=False, action='store_true',
+                      dest='resume')
+    parser.add_option('--stats', default=False, action='store_true',
+                      dest='stats', help='print stages timings and counters')
+    parser.add_option('--face-space-threshold', type='float', default=None,
+                      dest='face_space_threshold',
+                      help='reject faces farther than this from face space '
+                           '(0 to 1) without matching them')
+    parser.add_option('--weights-dtype', type='choice',
+                      choices=['float16', 'int8'], dest='weights_dtype',
+                      help='search gallery weights stored as this type')
+    parser.add_option('--eigenfaces-dtype', type='choice',
+                      choices=['float16', 'int8'], dest='eigenfaces_dtype',
+                      help='project faces over eigenfaces stored as this '
+                           'type')
+    parser.add_option('--memo', default=False, action='store_true',
+                      dest='memo', help='cache detections and matches by '
+                                        'image contents')
+    parser.add_option('--memo-dir', dest='memo_dir',
+                      help='keep cached detections and matches at this '
+                           'directory too (implies --memo)')
+    parser.add_option('--fast-training', default=False, action='store_true',
+                      dest='fast_training',
+                      help='build galleries in float32 computing only the '
+                           'kept eigenfaces')
+    parser.add_option('--fast-components', type='int', default=None,
+                      dest='fast_components',
+                      help='eigenfaces kept by --fast-training builds')
 
     (options, args) = parser.parse_args()
 
+    from pyfaces import cache, eigenfaces
+    from pyfaces.memo import MEMO
+    if options.cache_dir:
+        cache.CACHE_DIR = options.cache_dir
+    MEMO.enabled = options.memo or bool(options.memo_dir)
+    MEMO.directory = options.memo_dir
+    eigenfaces.FACE_SPACE_THRESHOLD = options.face_space_threshold
+    eigenfaces.WEIGHTS_DTYPE = options.weights_dtype
+    eigenfaces.EIGENFACES_DTYPE = options.eigenfaces_dtype
+    STATS.enabled = options.stats
+    eigenfaces.FAST_TRAINING = options.fast_training
+    if options.fast_components:
+        eigenfaces.FAST_COMPONENTS = options.fast_components
+
 
     if options.extract:
         if not options.faces or not options.extract_src:
             parser.print_help()
             sys.exit(2)
         src = options.extract_src
-        images = listdir(src)
-        if images:
-            for image in images:
-                faces = extract(join(src, image), options.faces)
-                print 'Faces found for "%s": %s' % (image, ', '.join(faces))
+        if listdir(src):
+            from detect.batch import extract_directory, processed, \
+                                     write_results
+            done = None
+            if options.resume and options.output and options.output != '-':
+                done = processed(options.output)
+            results = extract_directory(src, options.faces, options.jobs,
+                                        done=done)
+            if options.output:
+                results = write_results(results, options.output)
+            for result in results:
+                if options.output == '-':
+                    continue
+                image = basename(result['image'])
+                if 'error' in result:
+                    print 'Error on "%s": %s' % (image, result['error'])
+                else:
+                    print 'Faces found for "%s": %s' % \
+                                (image, ', '.join(result['faces']))
         else:
             print 'No faces recognised on the photo'
+    elif options.video:
+        for index, faces in find_people_video(options.video, options.people,
+                                              options.threshold,
+                                              options.every):
+            names = [name for box, (name, match, dist) in faces if name]
+            if names:
+                print '%d: %s' % (index, ', '.join(names))
     else:
-        if not options.image or not options.faces:
+        if not options.image:
             parser.print_help()
             sys.exit(2)
         people = find_people(options.image, options.faces, options.people,
@@ -84,6 +198,10 @@ if __name__ == '__main__':
                      ', '.join(('\n\t%s (%s %s)' % person for person in people)))
 
             if options.show:
+                from pyfaces.utils import merge_images
                 merge_images([options.image] + [person[1] for person in people]).show()
         else:
             print 'No body was recognised on the photo'
+
+    if options.stats:
+        print >> sys.stderr, STATS.report()
@@ -0,0 +1,205 @@
+#!/usr/bin/python
+"""
+Gallery ingestion, normalizes a people gallery once into a canonical
+gallery the bundles are built from.
+
+Images of any size, mode and format at `source` (a folder per person)
+are converted to grayscale, center cropped to the face size aspect
+ratio and resized to `size`, then saved as PGM at the same person
+folder under `destination`. With `align`, images are cropped to their
+largest detected face first (plus ALIGN_MARGIN around it), images with
+no face detected are kept whole. Only images newer than their output
+are converted again, and once converted, outputs of earlier ingests
+whose source was removed are removed too (they're listed at
+OUTPUTS_NAME), so ingesting again keeps the gallery in sync. Other
+files at `destination` are never removed, and `destination` can't be
+`source` or inside it:
+
+    $ python ingest.py -s photos/people -d gallery -S 92x112 -a
+    $ python faces.py -p gallery -i photo.jpg
+"""
+import sys
+import json
+import time
+import optparse
+from os import makedirs, remove
+from os.path import basename, exists, getmtime, join, splitext, realpath, \
+                    relpath, sep
+from multiprocessing import Pool, cpu_count
+
+import Image
+
+from pyfaces.eigenfaces import parse_gallery
+
+
+FACE_SIZE        = (92, 112)
+OUTPUT_EXTENSION = 'pgm'
+SETTINGS_NAME    = '.ingest.json'
+OUTPUTS_NAME     = '.ingest-outputs.json'
+ALIGN_MARGIN     = 0.1 # of the face size, in every direction
+CHUNK_SIZE       = 8
+
+
+def normalize(source, size=FACE_SIZE, align=False):
+    """ Returns `source` image (a path or a PIL image) as a grayscale PIL
+    image of `size`, cropped to its largest face if `align` is set """
+    img = Image.open(source) if isinstance(source, basestring) else source
+    img.load()
+    if align:
+        from detect.facedetect import detect # OpenCV only when aligning
+        boxes = detect(img)
+        if boxes:
+            (x1, y1), (x2, y2) = max(boxes, key=lambda ((x1, y1), (x2, y2)):
+                                                    (x2 - x1) * (y2 - y1))
+            margin_x = int((x2 - x1) * ALIGN_MARGIN)
+            margin_y = int((y2 - y1) * ALIGN_MARGIN)
+            img = img.crop((max(0, x1 - margin_x), max(0, y1 - margin_y),
+                            min(img.size[0], x2 + margin_x),
+                            min(img.size[1], y2 + margin_y)))
+    img = img.convert('L')
+
+    # crop to the face aspect ratio so faces aren't stretched
+    width, height = img.size
+    if width * size[1] > height * size[0]:
+        crop = height * size[0] // size[1]
+        img = img.crop(((width - crop) // 2, 0, (width + crop) // 2, height))
+    elif width * size[1] < height * size[0]:
+        crop = width * size[1] // size[0]
+        img = img.crop((0, (height - crop) // 2, width, (height + crop) // 2))
+    return img.resize(size, Image.ANTIALIAS)
+
+
+def _ingest_one((image, output, size, align)):
+    """ Pool worker, returns the result for `image` as a dict """
+    try:
+        normalize(image, size, align).save(output)
+        return {'image': image, 'output': output}
+    except Exception, e:
+        return {'image': image, 'error': str(e)}
+
+
+def ingest_gallery(source, destination, size=FACE_SIZE, align=False,
+                   jobs=None, force=False):
+    """ Normalizes the gallery at `source` into `destination`.
+
+    Parameters:
+        @source: gallery directory, a folder per person
+        @destination: canonical gallery directory, created if needed
+        @size: (width, height) of the normalized faces
+        @align: crop images to their largest detected face
+        @jobs: number of worker processes (defaults to the number of
+               cores)
+        @force: convert every image, even if its output is up to date
+
+    Returns:
+        Generator of {'image': path, 'output': path} dicts (or
+        {'image': path, 'error': message}) for converted images, in
+        completion order. Images ingested before with the same settings
+        and not modified since are skipped, images with the same output
+        as an earlier one (a.jpg and a.png) get an error.
+
+    Raises IOError if `destination` is `source` or inside it.
+    """
+    top = realpath(source)
+    if realpath(destination) == top or \
+       realpath(destination).startswith(top.rstrip(sep) + sep):
+        raise IOError, 'Destination "%s" is inside source "%s"' % \
+                            (destination, source)
+    return _ingest(source, destination, size, align, jobs, force)
+
+
+def _ingest(source, destination, size, align, jobs, force):
+    """ ingest_gallery generator """
+    if not exists(destination):
+        makedirs(destination)
+    settings = {'size': list(size), 'align': align}
+    settings_path = join(destination, SETTINGS_NAME)
+    if exists(settings_path):
+        with open(settings_path) as previous:
+            force = force or json.load(previous) != settings
+
+    images_list, labels = parse_gallery(source)
+    tasks, outputs = [], {}
+    for image, person in zip(images_list, labels):
+        folder = join(destination, person)
+        output = join(folder, '%s.%s' % (splitext(basename(image))[0],
+                                         OUTPUT_EXTENSION))
+        if output in outputs:
+            yield {'image': image,
+                   'error': 'Same output as "%s"' % outputs[output]}
+            continue
+        outputs[output] = image
+        if not force and exists(output) and getmtime(output) >= getmtime(image):
+            continue
+        if not exists(folder):
+            makedirs(folder)
+        tasks.append((image, output, tuple(size), align))
+
+    if tasks:
+        pool = Pool(jobs or cpu_count())
+        try:
+            for result in pool.imap_unordered(_ingest_one, tasks, CHUNK_SIZE):
+                yield result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    with open(settings_path, 'w') as current:
+        json.dump(settings, current)
+    remove_stale(destination, outputs)
+
+
+def remove_stale(destination, outputs):
+    """ Removes outputs of earlier ingests at `destination` gallery not in
+    `outputs`, and lists the existing `outputs` as the ingest outputs """
+    outputs_path = join(destination, OUTPUTS_NAME)
+    previous = []
+    if exists(outputs_path):
+        with open(outputs_path) as listed:
+            previous = [join(destination, name.encode('utf-8'))
+                            for name in json.load(listed)]
+    for path in previous:
+        if path not in outputs and exists(path):
+            remove(path)
+    with open(outputs_path, 'w') as listed:
+        json.dump(sorted(relpath(path, destination)
+                            for path in outputs if exists(path)), listed)
+
+
+def size(value):
+    """ Parses a WIDTHxHEIGHT option value """
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('-s', '--source', dest='source')
+    parser.add_option('-d', '--destination', dest='destination')
+    parser.add_option('-S', '--size', default='%dx%d' % FACE_SIZE,
+                      dest='size')
+    parser.add_option('-a', '--align', default=False, action='store_true',
+                      dest='align', help='crop images to their largest face')
+    parser.add_option('-j', '--jobs', type='int', default=None, dest='jobs')
+    parser.add_option('-F', '--force', default=False, action='store_true',
+                      dest='force', help='convert up to date images too')
+    (options, args) = parser.parse_args()
+
+    if not options.source or not options.destination:
+        parser.print_help()
+        sys.exit(2)
+
+    start, converted, errors = time.time(), 0, 0
+    for result in ingest_gallery(options.source, options.destination,
+                                 size(options.size), options.align,
+                                 options.jobs, options.force):
+        if 'error' in result:
+            errors += 1
+            print >> sys.stderr, 'Error on "%s": %s' % (result['image'],
+                                                        result['error'])
+        else:
+            converted += 1
+    elapsed = time.time() - start
+    print >> sys.stderr, '%d images converted, %d errors in %.2fs ' \
+                         '(%.1f images/s)' % (converted, errors, elapsed,
+                                              converted / (elapsed or 1))
@@ -0,0 +1,221 @@
+#!/usr/bin/python
+"""
+Streaming counterparts of find_people, extract and PyFaces.match.
+
+Photos go through a pipeline so reading the next photos overlaps
+detecting and matching the current ones: files are read on a pool of
+`readers` threads, decoded, detected and matched on a pool of
+`workers` threads and faces are written back on the readers pool. At
+most `max_pending` photos are in the pipeline, new ones are read only
+as results are consumed, so a slow consumer holds the producer back.
+Results are returned as an iterator, in completion order unless
+`ordered` is set:
+
+    for result in recognize_stream(photos, 'people'):
+        print result['image'], result.get('people') or result['error']
+
+The heavy stages (decoding, OpenCV, numpy) release the interpreter
+lock, so threads run them in parallel.
+"""
+import sys
+import json
+import optparse
+import Queue
+from cStringIO import StringIO
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from os import listdir
+from os.path import join
+
+import Image
+
+from detect.extract import extract_faces, save_faces
+from faces import reduce_result, PEOPLE_DIRECTORY
+from pyfaces.eigenfaces import get_bundle, get_gallery_bundle, \
+                               match_bundle, parse_folder, is_image
+from pyfaces.pyfaces import THRESHOLD
+
+
+READERS          = 4
+PENDING_PER_JOB  = 2
+WAIT_TIMEOUT     = 1e6 # blocking gets can't be interrupted without one
+
+
+def stream(images, stages, readers=READERS, workers=None, max_pending=None,
+           ordered=False):
+    """ Runs every image path in `images` through `stages`.
+
+    Parameters:
+        @images: iterable of image paths, consumed lazily
+        @stages: list of (kind, function) where kind is 'io' (run on the
+                 readers pool) or 'cpu' (run on the workers pool), each
+                 function gets and returns the result dict, which starts
+                 as {'image': path, '_data': file contents}
+        @readers: readers (and writers) threads
+        @workers: workers threads, defaults to the number of cores
+        @max_pending: images in the pipeline at most, defaults to
+                      PENDING_PER_JOB per thread
+        @ordered: yield results in `images` order
+
+    Yields:
+        result dicts as returned by the last stage without the keys
+        starting with an underscore, failed images get an 'error'
+        message instead.
+    """
+    workers = workers or cpu_count()
+    max_pending = max_pending or PENDING_PER_JOB * (readers + workers)
+    pools = {'io': ThreadPool(readers), 'cpu': ThreadPool(workers)}
+    results = Queue.Queue()
+    stages = [('io', read_image)] + list(stages)
+
+    def run(result, step):
+        """ Runs stage `step` on the matching pool, chaining the next """
+        def done(value):
+            if step + 1 < len(stages) and 'error' not in value:
+                run(value, step + 1)
+            else:
+                results.put((value['_index'],
+                             dict((key, item) for key, item
+                                    in value.iteritems()
+                                        if not key.startswith('_'))))
+        kind, function = stages[step]
+        pools[kind].apply_async(guarded, (function, result), callback=done)
+
+    try:
+        images, pending, index, next_index = iter(images), 0, 0, 0
+        waiting = {}
+        while True:
+            while pending < max_pending:
+                image = next(images, None)
+                if image is None:
+                    break
+                run({'image': image, '_index': index}, 0)
+                pending, index = pending + 1, index + 1
+            if not pending:
+                break
+            done_index, result = results.get(True, WAIT_TIMEOUT)
+            if not ordered:
+                pending -= 1
+                yield result
+                continue
+            # results waiting for an earlier one still count as pending
+            waiting[done_index] = result
+            while next_index in waiting:
+                pending -= 1
+                yield waiting.pop(next_index)
+                next_index += 1
+    finally:
+        for pool in pools.itervalues():
+            pool.terminate()
+            pool.join()
+
+
+def guarded(function, result):
+    """ Returns function(result), or result with the error message if it
+    raises """
+    try:
+        return function(result)
+    except Exception, e:
+        result['error'] = str(e)
+        return result
+
+
+def read_image(result):
+    """ Reads result image file contents """
+    with open(result['image'], 'rb') as image:
+        result['_data'] = StringIO(image.read())
+    return result
+
+
+def recognize_stream(images, people=PEOPLE_DIRECTORY, threshold=THRESHOLD,
+                     faces=None, bundle=None, **options):
+    """ Streams find_people results for `images` as
+    {'image': path, 'people': [(name, match, distance), ...]}, faces are
+    saved at `faces` directory if given. The `people` gallery bundle is
+    loaded once (or `bundle` is used), see stream for `options` """
+    bundle = bundle or get_gallery_bundle(people)
+
+    def detect_faces(result):
+        result['_faces'] = extract_faces(result['_data'])
+        return result
+
+    def save(result):
+        if faces:
+            save_faces(result['image'], result['_faces'], faces)
+        return result
+
+    def recognize(result):
+        crops = [face for box, face in result['_faces']]
+        candidates = match_bundle(bundle, crops, threshold)
+        result['people'] = reduce_result([(person, match, dist)
+                                            for dist, match, person
+                                                in candidates if match])
+        return result
+
+    return stream(images, [('cpu', detect_faces), ('io', save),
+                           ('cpu', recognize)], **options)
+
+
+def extract_stream(images, directory, **options):
+    """ Streams extract results for `images` as
+    {'image': path, 'faces': [saved face path, ...]}, see stream for
+    `options` """
+    def detect_faces(result):
+        result['_faces'] = extract_faces(result['_data'])
+        return result
+
+    def save(result):
+        result['faces'] = save_faces(result['image'], result['_faces'],
+                                     directory)
+        return result
+
+    return stream(images, [('cpu', detect_faces), ('io', save)], **options)
+
+
+def match_stream(images, directory, threshold=THRESHOLD, **options):
+    """ Streams PyFaces.match results for face `images` against faces at
+    `directory` as {'image': path, 'match': path, 'distance': value}
+    (None values if there's no match), see stream for `options` """
+    bundle = get_bundle(directory, parse_folder(directory, is_image))
+
+    def match_face(result):
+        dist, match, label = match_bundle(bundle,
+                                          [Image.open(result['_data'])],
+                                          threshold)[0]
+        result.update({'match': match, 'distance': dist})
+        return result
+
+    return stream(images, [('cpu', match_face)], **options)
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('-s', '--source', dest='source')
+    parser.add_option('-f', '--faces', dest='faces')
+    parser.add_option('-p', '--people', default=PEOPLE_DIRECTORY,
+                      dest='people')
+    parser.add_option('-t', '--threshold', type='float', default=THRESHOLD,
+                      dest='threshold')
+    parser.add_option('-r', '--readers', type='int', default=READERS,
+                      dest='readers')
+    parser.add_option('-w', '--workers', type='int', default=None,
+                      dest='workers')
+    parser.add_option('-m', '--max-pending', type='int', default=None,
+                      dest='max_pending')
+    parser.add_option('-O', '--ordered', default=False, action='store_true',
+                      dest='ordered')
+    (options, args) = parser.parse_args()
+
+    if not options.source:
+        parser.print_help()
+        sys.exit(2)
+
+    images = (join(options.source, name)
+                for name in sorted(listdir(options.source)))
+    for result in recognize_stream(images, options.people, options.threshold,
+                                   options.faces, readers=options.readers,
+                                   workers=options.workers,
+                                   max_pending=options.max_pending,
+                                   ordered=options.ordered):
+        print json.dumps(result)
+        sys.stdout.flush()
@@ -0,0 +1,128 @@
+"""
+Bundle cache file format.
+
+A cache file is a small JSON header followed by raw, aligned arrays so
+it can be opened with numpy.memmap without deserializing anything, and
+several processes reading the same cache share the same page cache.
+
+Layout:
+    MAGIC | version (uint32) | header length (uint64) | JSON header |
+    padding | array | padding | array ...
+
+The header holds plain values (`fields`) and, for every array, its
+name, dtype, shape and offset relative to the data section start.
+"""
+import os, json, struct, tempfile
+from hashlib import sha1
+from os.path import abspath, dirname, exists, getmtime, getsize, join
+
+from numpy import dtype as np_dtype, memmap, zeros, ascontiguousarray
+
+
+MAGIC          = 'PYFACES\0'
+FORMAT_VERSION = 1
+ALIGNMENT      = 64
+PREAMBLE       = struct.Struct('<IQ')
+CACHE_DIR      = os.environ.get('PYFACES_CACHE_DIR') or None
+VALIDATION     = os.environ.get('PYFACES_CACHE_VALIDATION') or 'stat'
+HASH_BLOCK     = 1 << 20
+CACHE_MODE     = 0644
+
+
+def cache_path(directory, name, cache_dir=None):
+    """ Returns the path of cache `name` for `directory`. Caches live in
+    `directory` unless `cache_dir` (or CACHE_DIR) is set, which allows
+    read-only galleries, in that case the file name is prefixed by a
+    digest of `directory` absolute path to avoid collisions """
+    cache_dir = cache_dir or CACHE_DIR
+    if not cache_dir:
+        return join(directory, name)
+    key = sha1(abspath(directory)).hexdigest()[:16]
+    return join(cache_dir, '%s-%s' % (key, name))
+
+
+def fingerprint(images_list, validation=None):
+    """ Returns a fingerprint of files in `images_list` used to detect
+    stale caches. `validation` is 'stat' (size and mtime, default) or
+    'hash' (sha1 of the contents, slower but survives copies/touches) """
+    validation = validation or VALIDATION
+    if validation == 'hash':
+        return [file_digest(name) for name in images_list]
+    return [[getsize(name), getmtime(name)] for name in images_list]
+
+
+def file_digest(name):
+    """ Returns the sha1 hex digest of `name` contents """
+    digest = sha1()
+    with open(name, 'rb') as handle:
+        for block in iter(lambda: handle.read(HASH_BLOCK), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def save(path, fields, arrays):
+    """ Saves `fields` (JSON serializable values) and `arrays` (dict of
+    name -> numpy array, None values are skipped) at `path`. The file is
+    written aside and renamed so readers never see a partial cache """
+    arrays = dict((name, ascontiguousarray(value))
+                        for name, value in arrays.iteritems()
+                            if value is not None)
+    descriptors, offset = [], 0
+    for name in sorted(arrays):
+        value = arrays[name]
+        descriptors.append({'name': name, 'dtype': value.dtype.str,
+                            'shape': list(value.shape), 'offset': offset})
+        offset = _align(offset + value.nbytes)
+    header = json.dumps({'fields': fields, 'arrays': descriptors})
+    start = _align(len(MAGIC) + PREAMBLE.size + len(header))
+
+    directory = dirname(abspath(path))
+    if not exists(directory):
+        os.makedirs(directory)
+    fd, tmp_name = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        os.chmod(tmp_name, CACHE_MODE)
+        with os.fdopen(fd, 'wb') as handle:
+            handle.write(MAGIC)
+            handle.write(PREAMBLE.pack(FORMAT_VERSION, len(header)))
+            handle.write(header)
+            for descriptor in descriptors:
+                handle.seek(start + descriptor['offset'])
+                # straight from the array buffer, memmaps aren't copied
+                arrays[descriptor['name']].tofile(handle)
+        os.rename(tmp_name, path)
+    except:
+        if exists(tmp_name):
+            os.remove(tmp_name)
+        raise
+
+
+def load(path):
+    """ Loads cache at `path` returning (fields, arrays), arrays are read
+    only numpy.memmap instances. Returns (None, None) if the file doesn't
+    exist or isn't a cache of the current format version """
+    if not exists(path):
+        return None, None
+    with open(path, 'rb') as handle:
+        if handle.read(len(MAGIC)) != MAGIC:
+            return None, None
+        version, length = PREAMBLE.unpack(handle.read(PREAMBLE.size))
+        if version != FORMAT_VERSION:
+            return None, None
+        header = json.loads(handle.read(length))
+    start = _align(len(MAGIC) + PREAMBLE.size + length)
+
+    arrays = {}
+    for descriptor in header['arrays']:
+        dtype, shape = np_dtype(descriptor['dtype']), tuple(descriptor['shape'])
+        if not all(shape): # numpy can't map empty regions
+            arrays[descriptor['name']] = zeros(shape, dtype)
+        else:
+            arrays[descriptor['name']] = memmap(path, dtype, 'r',
+                                                start + descriptor['offset'],
+                                                shape)
+    return header['fields'], arrays
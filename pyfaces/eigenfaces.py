@@ -1,12 +1,39 @@
-import pickle, math, shutil, tempfile, Image
-from os import listdir, mkdir
-from os.path import exists, isdir, isfile, join, normpath, basename
-
-from numpy import max, zeros, average, dot, asfarray, sort, trace, argmin
-from numpy.linalg import eigh, svd
+import shutil, Image
+from uuid import uuid4
+from glob import glob
+from hashlib import sha1
+from os import listdir, mkdir, makedirs, remove
+from os.path import exists, isdir, isfile, join, normpath, basename, sep, \
+                    abspath, getmtime, getsize
+
+from numpy import max, zeros, average, dot, asfarray, sort, \
+                  load as load_array, save as save_array, ndarray, \
+                  asarray, uint8, float32, float64, sqrt, maximum, \
+                  concatenate, finfo, ones, isfinite
+from numpy.linalg import eigh, svd, qr
+from numpy.random import RandomState
+
+from cache import cache_path, fingerprint, save as save_cache, \
+                  load as load_cache
+from incremental import update_eigenspace
+from index import BruteIndex, INDEXES, quantize, build as build_index, \
+                  load as load_index
+import index as index_module # RERANK is read at match time
+from streaming import fits_memory, chunk_rows, chunks, load_facets, \
+                      eigenspace as streaming_eigenspace, \
+                      randomized as streaming_randomized, \
+                      project as project_facets
+from stats import STATS
+from memo import MEMO, content_key
 
 
 CACHE_FILE_NAME   = 'saveddata.cache'
+GALLERY_FILE_NAME = 'gallery.cache'
+PIXELS_DIR_NAME   = '.pixels'
+IMAGE_EXTENSIONS  = ('jpg', 'jpeg', 'png', 'pgm', 'bmp', 'gif')
+BUNDLE_ARRAYS     = ('adjfaces', 'eigenfaces', 'avg', 'evals', 'weights')
+INDEX_PREFIX      = 'index.'
+COMPACT_PREFIX    = 'compact.'
 AVERAGE_FILE_NAME = 'average.png'
 RECON_DIRNAME     = 'reconfaces'
 EIGENFACES_DIR    = 'eigenfaces'
@@ -15,26 +42,85 @@ RECONPHI_FMT      = 'reconphi-%s.png'
 RECONX_FMT        = 'reconx-%s.png'
 USE_EIGH          = True
 MAKE_AVERAGE      = False
+KEEP_ADJFACES     = False
+INCREMENTAL       = True
+MAX_DRIFT         = 0.1
+MAX_CHANGED       = 0.5
+# Gallery weights are searched exhaustively, INDEX_TYPE indexes are only
+# built for galleries of INDEX_MIN_SIZE images or more with at most
+# INDEX_MAX_DIMENSIONS kept eigenfaces, k-d trees can't prune in more
+INDEX_TYPE        = 'brute'
+INDEX_MIN_SIZE    = 1024
+INDEX_MAX_DIMENSIONS = 16
+# Fast training works in TRAINING_DTYPE and only computes the kept
+# eigenfaces (FAST_COMPONENTS unless given), with a randomized SVD when
+# they're less than RANDOMIZED_RATIO of the images
+FAST_TRAINING     = False
+FAST_COMPONENTS   = 64
+TRAINING_DTYPE    = float32
+RANDOMIZED_RATIO  = 0.25
+OVERSAMPLES       = 10
+POWER_ITERATIONS  = 2
+TRAINING_SEED     = 0
+# Probes whose distance from face space (the fraction of their energy
+# the kept eigenfaces can't reconstruct) is over this are rejected as
+# non faces before searching, None searches every probe
+FACE_SPACE_THRESHOLD = None
+# Compact storage: gallery weights are searched on a WEIGHTS_DTYPE
+# ('float16' or 'int8') copy, see index.QuantizedIndex, and probes are
+# projected over an EIGENFACES_DTYPE copy of the eigenfaces, None keeps
+# the training precision. Both copies are saved in the cache next to the
+# exact arrays, which are then only read to re-rank and update bundles
+WEIGHTS_DTYPE     = None
+EIGENFACES_DTYPE  = None
+PROJECT_ROWS      = 64
 
 
 class FaceBundle(object):
     """ Faces Bundle representation """
     def __init__(self, directory, images_list, width, height, adjfaces,
-                 eigenfaces, avg, evals):
+                 eigenfaces, avg, evals, labels=None, weights=None,
+                 drift=0.0, changed=0, version=None, fast=False):
         self.directory = directory
-        self.images_list = map(basename, images_list)
+        self.images_list = relative_names(directory, images_list)
         self.width = width
         self.height = height
         self.adjfaces = adjfaces
         self.eigenfaces = eigenfaces
         self.average = avg
         self.evals = evals
+        # labels[i] is the person owning images_list[i] on gallery bundles
+        self.labels = labels
+        # weights[i] is images_list[i] projected over the kept eigenfaces
+        self.weights = weights
+        # energy fraction lost by incremental updates and images added or
+        # removed since the last full build
+        self.drift = drift
+        self.changed = changed
+        # built in fast training mode, see create_face_bundle
+        self.fast = fast
+        # nearest neighbour index over weights, see index module
+        self.index = None
+        # new on every build or update, names cached match results
+        self.version = version or uuid4().hex
+        # squared eigenfaces norms, see face_space_distance
+        self.norms = None
+        # (codes, scales) EIGENFACES_DTYPE eigenfaces, see project_faces
+        self.compact = None
 
     def as_dict(self):
         return { 'directory': self.directory, 'images_list': self.images_list,
                  'width': self.width, 'height': self.height,
                  'adjfaces': self.adjfaces, 'eigenfaces': self.eigenfaces,
-                 'avg': self.average, 'evals': self.evals }
+                 'avg': self.average, 'evals': self.evals,
+                 'labels': self.labels, 'weights': self.weights,
+                 'drift': self.drift, 'changed': self.changed,
+                 'version': self.version, 'fast': self.fast }
+
+    @property
+    def components(self):
+        """ Number of eigenfaces with precomputed weights """
+        return self.weights.shape[1]
 
 
 def find_matching_image(image, directory, threshold, egfnum=None, resize=True):
@@ -42,7 +128,7 @@ def find_matching_image(image, directory, threshold, egfnum=None, resize=True):
     a `threshold` distance
 
     Parameters:
-        @image: image to match
+        @image: image to match (path, PIL image or 2d grayscale array)
         @directory: images to compare against
         @threshold: max distance allowed between candidate and image
         @egfnum: max eigenfaces to compare with
@@ -53,61 +139,310 @@ def find_matching_image(image, directory, threshold, egfnum=None, resize=True):
         @mindist: distance between image and best coincidence
         @image: conicidence image
     """
-    extension = image.split('.')[-1]
-    images_list = parse_folder(directory,
-                               lambda name: name.lower().endswith(extension))
+    # listed as find_matching_images does, both share the cache file
+    images_list = parse_folder(directory, is_image)
+    bundle = get_bundle(directory, images_list, egfnum=egfnum)
+    mindist, match, label = match_bundle(bundle, [image], threshold, egfnum,
+                                         resize)[0]
+    return (mindist, match)
+
+
+def find_matching_person(image, directory, threshold, egfnum=None,
+                         resize=True):
+    """ Finds the person at `directory` gallery that matches `image`
+    between a `threshold` distance. Every folder in `directory` holds
+    the faces of a single person, all of them are merged in a single
+    eigenspace so just one projection and search is done per query
+    (see find_matching_people for galleries that can't be merged).
 
-    numimgs = len(images_list)
-    if not egfnum or egfnum >= numimgs:
-        egfnum = numimgs / 2
+    Parameters:
+        @image: image to match
+        @directory: gallery directory, one folder per person
+        @threshold: max distance allowed between candidate and image
+        @egfnum: max eigenfaces to compare with
+        @resize: resize the candidate image if it's smaller or bigger than
+                 faces to compare
+    Returns:
+        (mindist, image, person)
+        @mindist: distance between image and best coincidence
+        @image: conicidence image
+        @person: name of the folder holding the coincidence image
+    """
+    return find_matching_people([image], directory, threshold, egfnum,
+                                resize)[0]
 
-    bundle = get_bundle(directory, images_list)
 
-    # calculate weights
-    weights = dot(bundle.eigenfaces[:egfnum,:],
-                  bundle.adjfaces.transpose()).transpose()
+def find_matching_images(images, directory, threshold, egfnum=None,
+                         resize=True):
+    """ Batched find_matching_image, matches every image in `images`
+    (paths, PIL images or 2d grayscale arrays) against `directory` with a
+    single projection and distance computation.
 
-    img = Image.open(image).convert('L')
+    Returns:
+        [(mindist, image), ...] one per image in `images`, (None, None)
+        for images with no match
+    """
+    if not images:
+        return []
+    images_list = parse_folder(directory, is_image)
+    bundle = get_bundle(directory, images_list, egfnum=egfnum)
+    return [(dist, match) for dist, match, label in
+                match_bundle(bundle, images, threshold, egfnum, resize)]
+
+
+def find_matching_people(images, directory, threshold, egfnum=None,
+                         resize=True):
+    """ Batched find_matching_person, matches every image in `images`
+    (paths, PIL images or 2d grayscale arrays) against `directory` gallery
+    with a single projection and distance computation. Galleries whose
+    bundle can't be built (people faces of different sizes) are matched
+    a person at a time, see match_people.
+
+    Returns:
+        [(mindist, image, person), ...] one per image in `images`,
+        (None, None, None) for images with no match
+    """
+    if not images:
+        return []
+    try:
+        bundle = get_gallery_bundle(directory, egfnum)
+    except IOError:
+        return match_people(images, directory, threshold, egfnum, resize)
+    return match_bundle(bundle, images, threshold, egfnum, resize)
+
+
+def match_people(images, directory, threshold, egfnum=None, resize=True):
+    """ Matches every image in `images` against each person folder of
+    `directory` gallery on its own bundle (see find_matching_images), the
+    closest person is kept. Returns as find_matching_people """
+    best = [(None, None, None)] * len(images)
+    for person in parse_folder(directory, is_person):
+        found = find_matching_images(images, person, threshold, egfnum,
+                                     resize)
+        best = [(dist, match, basename(person))
+                    if match is not None and
+                       (current[1] is None or dist < current[0])
+                    else current
+                        for current, (dist, match) in zip(best, found)]
+    return best
+
+
+def match_bundle(bundle, images, threshold, egfnum=None, resize=True):
+    """ Matches every image in `images` against an already loaded
+    `bundle`, see find_matching_people.
+
+    Returns:
+        [(mindist, image, label), ...] one per image in `images`, label
+        is None on single person bundles, (None, None, None) for images
+        with no match
+    """
+    return [matches[0] if matches else (None, None, None)
+                for matches in match_bundle_top(bundle, images, threshold,
+                                                1, egfnum, resize)]
+
+
+def match_bundle_top(bundle, images, threshold, top, egfnum=None,
+                     resize=True):
+    """ Returns the `top` matches closer than `threshold` of every image
+    in `images` against an already loaded `bundle`.
+
+    Results are cached at MEMO (if enabled) under the image contents and
+    the bundle version, only images not found there are searched.
+
+    Returns:
+        [[(distance, image, label), ...], ...] a list of matches sorted
+        by distance per image in `images`
+    """
+    if not images:
+        return []
+    labels = bundle.labels or [None] * len(bundle.images_list)
+    # compact settings change results without a new bundle version
+    keys = [content_key(image, egfnum, top, threshold, resize,
+                        FACE_SPACE_THRESHOLD, WEIGHTS_DTYPE, EIGENFACES_DTYPE,
+                        index_module.RERANK)
+                if MEMO.enabled else None for image in images]
+    found = [MEMO.get(bundle.version, key) if key else None for key in keys]
+    missing = [i for i, matches in enumerate(found) if matches is None]
+    if missing:
+        faces = load_faces_batch([images[i] for i in missing], bundle, resize)
+        for i, matches in zip(missing, search_faces(bundle, faces, egfnum,
+                                                    top, threshold)):
+            found[i] = [(int(idx), float(dist)) for idx, dist in matches]
+            if keys[i]:
+                MEMO.put(bundle.version, keys[i], found[i])
+    return [[(dist, join(bundle.directory, bundle.images_list[idx]),
+              labels[idx]) for idx, dist in matches]
+                for matches in found]
+
+
+def load_faces_batch(images, bundle, resize=True):
+    """ Returns a 2d array with a row per image in `images` holding its
+    mean adjusted face vector for `bundle` eigenspace """
+    faces = zeros((len(images), bundle.width * bundle.height))
+    with STATS.timer('match.load'):
+        for i, image in enumerate(images):
+            faces[i] = load_face(image, bundle, resize)
+    return faces
+
+
+def load_face(image, bundle, resize=True):
+    """ Loads `image` (a path, a PIL image or a 2d grayscale array) as a
+    mean adjusted face vector for `bundle` eigenspace, resizing is done
+    in memory. Raises IOError if sizes differ and `resize` is False """
+    if isinstance(image, ndarray):
+        img = Image.fromarray(asarray(image, uint8)).convert('L')
+    elif isinstance(image, basestring):
+        img = Image.open(image).convert('L')
+    else:
+        img = image.convert('L')
     if img.size != (bundle.width, bundle.height):
         if resize:
-            tmp = tempfile.NamedTemporaryFile(suffix='.' + extension)
-            img.resize((bundle.width, bundle.height)).save(tmp)
-            img = Image.open(tmp.name)
+            img = img.resize((bundle.width, bundle.height))
         else:
             raise IOError, 'Select image of correct size.'
 
     pixels = asfarray(img.getdata())
-    face = (pixels / max(pixels)) - bundle.average
-
-    input_weight = dot(bundle.eigenfaces[:egfnum,:], face.transpose())
-    dist = ((weights - input_weight.transpose()) ** 2).sum(axis=1)
-    idx = argmin(dist)
-    mindist = math.sqrt(dist[idx])
-    #reconstruct_faces(bundle, egfnum, weights)
-
-    if mindist < threshold:
-        return (mindist, join(directory, bundle.images_list[idx]))
+    return (pixels / max(pixels)) - bundle.average
+
+
+def search_faces(bundle, faces, egfnum=None, top=1, radius=None):
+    """ Returns [(index, distance), ...] with the `top` closest faces in
+    `bundle` to each row of mean adjusted `faces`, closer than `radius`
+    if given, using `egfnum` eigenfaces (defaults to half the bundle
+    images). Probes are projected with a single matrix product and
+    searched on the bundle index, which covers every kept eigenface,
+    other `egfnum` values search exhaustively. If FACE_SPACE_THRESHOLD
+    is set, probes too far from face space get no matches without being
+    searched. """
+    egfnum = min(eigenfaces_number(len(bundle.images_list), egfnum),
+                 bundle.components)
+    rejecting = FACE_SPACE_THRESHOLD is not None
+    # the distance from face space needs every kept eigenface
+    projected = bundle.components if rejecting else egfnum
+
+    # gallery weights are precomputed, just project the probe faces
+    with STATS.timer('match.project'):
+        input_weights = project_faces(bundle, faces, projected)
+    if rejecting:
+        with STATS.timer('match.reject'):
+            near = face_space_distance(bundle, faces, input_weights) <= \
+                        FACE_SPACE_THRESHOLD
+        STATS.incr('match.rejected', len(faces) - int(near.sum()))
+        input_weights = input_weights[near,:egfnum]
+
+    if bundle.index is not None and egfnum == bundle.components:
+        index = bundle.index
     else:
-        return (None, None)
-
-
-def create_face_bundle(directory, images_list):
-    """ Creates FaceBundle """
-    images = validate_directory(images_list)
-
-    img = images[0]
-    width, height = img.size
-    pixels = width * height
-    numimgs = len(images)
+        index = BruteIndex(bundle.weights[:,:egfnum])
+    STATS.incr('match.probes', len(input_weights))
+    with STATS.timer('match.search'):
+        found = index.query_many(input_weights, top, radius)
+    if not rejecting:
+        return found
+    found = iter(found)
+    return [next(found) if accepted else [] for accepted in near]
+
+
+def project_faces(bundle, faces, count):
+    """ Returns mean adjusted `faces` projected over the first `count`
+    `bundle` eigenfaces. If EIGENFACES_DTYPE is set they're projected over
+    the compact eigenfaces instead (see compact_eigenfaces), decoded
+    PROJECT_ROWS at a time """
+    if not EIGENFACES_DTYPE:
+        return dot(faces, bundle.eigenfaces[:count,:].transpose())
+    codes, scales = compact_eigenfaces(bundle)
+    weights = zeros((len(faces), count))
+    for part in chunks(count, PROJECT_ROWS):
+        weights[:,part] = dot(faces, asarray(codes[part], float32) \
+                                        .transpose()) * scales[part]
+    return weights
+
+
+def compact_eigenfaces(bundle):
+    """ Returns (codes, scales), `bundle` kept eigenfaces coded as
+    EIGENFACES_DTYPE with a scale per eigenface. They're loaded from the
+    cache or coded once """
+    if bundle.compact is None or \
+       bundle.compact[0].dtype.name != EIGENFACES_DTYPE:
+        codes, scales = quantize(bundle.eigenfaces[:bundle.components]
+                                        .transpose(),
+                                 INDEXES[EIGENFACES_DTYPE].dtype,
+                                 INDEXES[EIGENFACES_DTYPE].levels)
+        bundle.compact = (codes.transpose().copy(), scales)
+        bundle.norms = None
+    return bundle.compact
+
+
+def face_space_distance(bundle, faces, weights):
+    """ Returns the distance from face space of every row of mean
+    adjusted `faces`, projected as `weights` over every `bundle` kept
+    eigenface: the fraction of its energy lost when reconstructed from
+    them, 0 for faces in face space up to 1. Empty faces are at 1. """
+    if bundle.norms is None and EIGENFACES_DTYPE:
+        # of the eigenfaces weights are projected over
+        codes, scales = compact_eigenfaces(bundle)
+        bundle.norms = zeros(len(codes))
+        for part in chunks(len(codes), PROJECT_ROWS):
+            bundle.norms[part] = (asarray(codes[part], float32) ** 2) \
+                                    .sum(axis=1) * scales[part] ** 2
+    elif bundle.norms is None:
+        # eigenfaces are orthogonal, scaled by their eigenvalues
+        bundle.norms = (asarray(bundle.eigenfaces[:bundle.components],
+                                float64) ** 2).sum(axis=1)
+    energy = (faces ** 2).sum(axis=1)
+    kept = (weights ** 2 / maximum(bundle.norms, finfo(float64).tiny)) \
+                .sum(axis=1)
+    distance = ones(len(faces))
+    valid = isfinite(energy)
+    valid[valid] = energy[valid] > 0
+    distance[valid] = 1 - kept[valid] / energy[valid]
+    return distance.clip(0, 1)
+
+
+def eigenfaces_number(numimgs, egfnum=None):
+    """ Returns the number of eigenfaces to use for `numimgs` images,
+    `egfnum` or half the images if not given or out of range """
+    if not egfnum or egfnum >= numimgs:
+        egfnum = numimgs / 2
+    return egfnum
+
+
+def kept_components(numimgs, egfnum=None, fast=False):
+    """ Returns the number of eigenfaces bundles of `numimgs` images keep:
+    `egfnum` (FAST_COMPONENTS if not given) in `fast` training mode, at
+    least half the images otherwise """
+    if fast:
+        return eigenfaces_number(numimgs, egfnum or FAST_COMPONENTS)
+    egfnum = eigenfaces_number(numimgs, egfnum)
+    return egfnum if egfnum > numimgs / 2 else numimgs / 2
+
+
+def create_face_bundle(directory, images_list, labels=None, egfnum=None,
+                       pixels_dir=None, fast=None):
+    """ Creates FaceBundle keeping the top `egfnum` eigenfaces (at least
+    half the images) and the gallery faces projected over them. Adjusted
+    faces are only kept if KEEP_ADJFACES is set. Decoded images are read
+    from (and added to) `pixels_dir` cache if given. If `fast` is set
+    (defaults to FAST_TRAINING) just `egfnum` eigenfaces (FAST_COMPONENTS
+    if not given) are computed in TRAINING_DTYPE precision, see
+    fast_eigenspace. Galleries too big to be built in memory are built
+    out of core, see streaming module """
+    if fast is None:
+        fast = FAST_TRAINING
+    if not images_list:
+        raise IOError, 'Folder empty'
+    dtype = TRAINING_DTYPE if fast else float64
+    width, height = Image.open(images_list[0]).size
+    if not fits_memory(len(images_list), width * height, dtype):
+        return create_face_bundle_streaming(directory, images_list, labels,
+                                            egfnum, pixels_dir, fast)
 
     # Create a 2d array, each row holds pixvalues of a single image
-    facet_matrix = zeros((numimgs, pixels))
-    for i in xrange(numimgs):
-        pixels = asfarray(images[i].getdata())
-        facet_matrix[i] = pixels / max(pixels)
+    width, height, facet_matrix = load_faces(images_list, pixels_dir, dtype)
+    numimgs = len(images_list)
 
     # Create average values, one for each column (ie pixel)
-    avg = average(facet_matrix, axis=0)
+    avg = average(facet_matrix, axis=0).astype(facet_matrix.dtype)
     if MAKE_AVERAGE:
         # Create average image in current directory just for fun of viewing
         make_image(avg, AVERAGE_FILE_NAME, (width, height))
@@ -115,51 +450,324 @@ def create_face_bundle(directory, images_list):
     # Substract avg val from each orig val to get adjusted faces (phi of T&P)
     adjfaces = facet_matrix - avg
     adjfaces_transpose = adjfaces.transpose()
-    L = dot(adjfaces, adjfaces_transpose)
 
-    if USE_EIGH:
-        evals1, evects1 = eigh(L)
+    kept = kept_components(numimgs, egfnum, fast)
+    if fast:
+        eigen_space, evals = fast_eigenspace(adjfaces, kept)
     else:
-        evects1, evals1, vt = svd(L, 0)
-    reversed_evalue_order = evals1.argsort()[::-1]
-    evects = evects1[:,reversed_evalue_order]
-    evals = sort(evals1)[::-1]
-
-    # Rows in eigen_space are eigenfaces
-    eigen_space = dot(adjfaces_transpose, evects).transpose()
-    # Normalize rows of eigen_space
-    for i in xrange(numimgs):
-        ui = eigen_space[i]
-        ui.shape = (height, width)
-        eigen_space[i] = eigen_space[i] / trace(dot(ui.transpose(), ui))
-
-    bundle = FaceBundle(directory, images_list, width, height, adjfaces,
-                        eigen_space, avg, evals)
+        L = dot(adjfaces, adjfaces_transpose)
+
+        if USE_EIGH:
+            evals1, evects1 = eigh(L)
+        else:
+            evects1, evals1, vt = svd(L, 0)
+        reversed_evalue_order = evals1.argsort()[::-1]
+        evects = evects1[:,reversed_evalue_order]
+        evals = sort(evals1)[::-1]
+
+        # Rows in eigen_space are eigenfaces, only kept ones are needed
+        eigen_space = dot(adjfaces_transpose, evects[:,:kept]).transpose()
+        # Normalize rows of eigen_space by their sum of squares (the
+        # trace of ui.transpose() * ui)
+        eigen_space /= (eigen_space ** 2).sum(axis=1)[:,None]
+
+    # Project the gallery once, queries only need to project the probe
+    weights = dot(eigen_space, adjfaces_transpose).transpose()
+
+    bundle = FaceBundle(directory, images_list, width, height,
+                        adjfaces if KEEP_ADJFACES else None, eigen_space,
+                        avg, evals, labels, weights, fast=fast)
     #create_eigenimages(bundle, eigen_space) # create eigenface images
     return bundle
 
 
-def get_bundle(directory, images_list):
+def create_face_bundle_streaming(directory, images_list, labels=None,
+                                 egfnum=None, pixels_dir=None, fast=None,
+                                 max_memory=None):
+    """ Creates FaceBundle as create_face_bundle does but decoding the
+    images one at a time and keeping at most `max_memory` bytes of faces
+    in memory (streaming.MAX_MEMORY by default), the rest is kept in
+    temporary files. Fast builds use a randomized SVD over the faces
+    when they keep less eigenfaces than images and pixels, exact builds
+    raise IOError if their scatter matrix doesn't fit in `max_memory`,
+    see streaming module """
+    if fast is None:
+        fast = FAST_TRAINING
+    dtype = TRAINING_DTYPE if fast else float64
+    numimgs = len(images_list)
+    STATS.incr('bundle.streamed')
+    with STATS.timer('bundle.load_faces'):
+        width, height, facets, avg = \
+                load_facets(images_list,
+                            lambda name: load_pixels(name, pixels_dir),
+                            dtype, max_memory)
+    rows = chunk_rows(width * height, dtype, max_memory)
+
+    kept = kept_components(numimgs, egfnum, fast)
+    if fast and kept + OVERSAMPLES < min(numimgs, width * height):
+        components, evals, energy = \
+                streaming_randomized(facets, avg, kept, rows, OVERSAMPLES,
+                                     POWER_ITERATIONS, TRAINING_SEED)
+        eigen_space, evals = scale_components(components, evals, energy,
+                                              dtype)
+    else:
+        eigen_space, evals = streaming_eigenspace(facets, avg, kept, rows,
+                                                  max_memory)
+        if fast: # just the kept eigenvalues and the energy left out
+            evals = concatenate([evals[:kept], [evals[kept:].sum()]])
+    weights = project_facets(facets, avg, eigen_space, rows, max_memory)
+    return FaceBundle(directory, images_list, width, height, None,
+                      eigen_space, avg, evals, labels, weights, fast=fast)
+
+
+def fast_eigenspace(adjfaces, kept):
+    """ Returns (eigenfaces, evals) for the top `kept` components of mean
+    adjusted faces at `adjfaces` rows, scaled as create_face_bundle does.
+    Components come from a randomized SVD (OVERSAMPLES extra directions
+    refined by POWER_ITERATIONS) when `kept` is small compared to the
+    images or from the images Gram matrix otherwise. The last value in
+    evals is the energy of the components left out. """
+    numimgs, dtype = len(adjfaces), adjfaces.dtype
+    total = float((adjfaces.astype(float64) ** 2).sum())
+    size = kept + OVERSAMPLES
+    if size < RANDOMIZED_RATIO * numimgs and size < adjfaces.shape[1]:
+        rng = RandomState(TRAINING_SEED)
+        sample = rng.standard_normal((adjfaces.shape[1], size)).astype(dtype)
+        basis, r = qr(dot(adjfaces, sample))
+        for i in xrange(POWER_ITERATIONS):
+            basis, r = qr(dot(adjfaces.transpose(), basis))
+            basis, r = qr(dot(adjfaces, basis))
+        u, values, vt = svd(dot(basis.transpose(), adjfaces), 0)
+        evals, components = values[:kept] ** 2, vt[:kept]
+    else:
+        evals1, evects1 = eigh(dot(adjfaces, adjfaces.transpose()))
+        order = evals1.argsort()[::-1][:kept]
+        evals = maximum(evals1[order], 0)
+        components = dot(adjfaces.transpose(), evects1[:,order]).transpose()
+        norms = sqrt((components ** 2).sum(axis=1))
+        components /= maximum(norms, finfo(dtype).eps)[:,None]
+
+    return scale_components(components, evals, total, dtype)
+
+
+def scale_components(components, evals, energy, dtype):
+    """ Returns (eigenfaces, evals) for unit `components` rows with
+    eigenvalues `evals` out of a total `energy`: eigenfaces are the
+    components over the root of their eigenvalue, as `dtype`, and the
+    energy left out is appended to evals """
+    root = sqrt(evals)
+    scale = zeros(len(root), dtype)
+    scale[root > finfo(dtype).eps] = 1 / root[root > finfo(dtype).eps]
+    eigenfaces = (components * scale[:,None]).astype(dtype)
+    tail = maximum(energy - float(evals.sum()), 0)
+    return eigenfaces, concatenate([evals, [tail]]).astype(float64)
+
+
+def get_gallery_bundle(directory, egfnum=None):
+    """ Builds or retrives the bundle for `directory` gallery, where every
+    folder holds the faces of a person, see get_bundle """
+    images_list, labels = parse_gallery(directory)
+    return get_bundle(directory, images_list, labels, GALLERY_FILE_NAME,
+                      egfnum=egfnum)
+
+
+def get_bundle(directory, images_list, labels=None,
+               cache_name=CACHE_FILE_NAME, cache_dir=None, egfnum=None):
     """ Builds or retrives bundle for images at `directory` directory.
-    Checks cache file on `directory` which is a pickled dictionary from
-    FaceBundle values instance with stats about the directory, like
-    images list to detect if it has changed (images were added or removed,
-    etc). The cache is created if it doesn't exists or the directory changed.
+    Checks cache file for `directory` (see cache.cache_path) which holds
+    FaceBundle values and a fingerprint of the images (sizes and mtimes
+    or contents digests) to detect if it has changed (images were added,
+    removed or modified, etc). If the directory changed the cached bundle
+    is updated incrementally (see update_bundle), the cache is created if
+    it doesn't exists, if it keeps less than `egfnum` eigenfaces or if the
+    update drifted too much. Decoded images are cached too so rebuilds
+    only decode changed images. `labels` names the person owning each
+    image on gallery bundles. Updates and rebuilds get a new bundle
+    version, cached match results of stale bundles are dropped.
     """
-    bundle, build_cache = None, True
-    cache_file = join(directory, CACHE_FILE_NAME)
-    if exists(cache_file):
-        cache = open(join(directory, CACHE_FILE_NAME))
-        bundle = FaceBundle(**pickle.load(cache))
-        cache.close()
-        build_cache = images_list != bundle.images_list
-
-    if build_cache: # Cache doesn't exists or `directory` changed
-        bundle = create_face_bundle(directory, images_list)
-        cache = open(cache_file, 'w')
-        pickle.dump(bundle.as_dict(), cache)
-        cache.close()
-    return bundle
+    cache_file = cache_path(directory, cache_name, cache_dir)
+    pixels_dir = cache_path(directory, PIXELS_DIR_NAME, cache_dir)
+    with STATS.timer('bundle.fingerprint'):
+        stamp = fingerprint(images_list)
+    with STATS.timer('bundle.cache_load'):
+        bundle, cached_stamp = load_bundle(cache_file)
+    if bundle is not None: # the cache may be shared from another path
+        bundle.directory = directory
+
+    # caches built in another training mode or with less eigenfaces than
+    # needed are built again
+    if bundle is not None and bundle.weights is not None and \
+       bool(bundle.fast) == bool(FAST_TRAINING) and \
+       bundle.components >= kept_components(len(images_list), egfnum,
+                                            FAST_TRAINING):
+        if cached_stamp == stamp and labels == bundle.labels and \
+           relative_names(directory, images_list) == bundle.images_list:
+            STATS.incr('bundle.cache_hits')
+            if bundle.index is not None and \
+               bundle.index.name == index_type(*bundle.weights.shape) and \
+               (not EIGENFACES_DTYPE or
+                (bundle.compact is not None and
+                 bundle.compact[0].dtype.name == EIGENFACES_DTYPE)):
+                return bundle
+            # compact settings changed, only the index and compact
+            # eigenfaces are built again
+        else:
+            STATS.incr('bundle.cache_stale')
+            MEMO.invalidate(bundle.version)
+            if INCREMENTAL:
+                with STATS.timer('bundle.update'):
+                    bundle = update_bundle(bundle, cached_stamp, images_list,
+                                           labels, stamp, egfnum, pixels_dir)
+                if bundle is not None:
+                    STATS.incr('bundle.updates')
+            else:
+                bundle = None
+    else:
+        STATS.incr('bundle.cache_misses')
+        bundle = None
+
+    if bundle is None: # Cache doesn't exists or needs a full build
+        STATS.incr('bundle.rebuilds')
+        with STATS.timer('bundle.build'):
+            bundle = create_face_bundle(directory, images_list, labels,
+                                        egfnum, pixels_dir)
+    bundle.index = gallery_index(bundle.weights)
+    try:
+        with STATS.timer('bundle.cache_save'):
+            save_bundle(cache_file, bundle, stamp)
+    except (IOError, OSError):
+        return bundle # read-only gallery, set a cache_dir to keep the cache
+    # served from the memory mapped cache like cached bundles, the arrays
+    # built in memory are dropped
+    saved, stamp = load_bundle(cache_file)
+    saved.directory = directory
+    return saved
+
+
+def update_bundle(bundle, stamp, images_list, labels, new_stamp, egfnum=None,
+                  pixels_dir=None):
+    """ Updates `bundle` built for images with fingerprint `stamp` to
+    images at `images_list` with fingerprint `new_stamp`, folding new and
+    modified images into the mean and eigenbasis and leaving out removed
+    ones. Returns None (a full build is needed) if the images changed
+    size, too many images changed since the last full build (MAX_CHANGED)
+    or the eigenspace drifted too much (MAX_DRIFT). """
+    names = relative_names(bundle.directory, images_list)
+    known = dict(zip(bundle.images_list, map(tuple_stamp, stamp)))
+    current = dict(zip(names, map(tuple_stamp, new_stamp)))
+    keep = [idx for idx, name in enumerate(bundle.images_list)
+                    if known[name] == current.get(name)]
+    kept_names = set(bundle.images_list[idx] for idx in keep)
+    added = [idx for idx, name in enumerate(names) if name not in kept_names]
+
+    numimgs = len(names)
+    changed = bundle.changed + numimgs - len(keep) + \
+                len(bundle.images_list) - len(keep)
+    if numimgs < 2 or not keep or changed > MAX_CHANGED * numimgs:
+        return None
+
+    new_faces = zeros((0, bundle.width * bundle.height))
+    if added:
+        width, height, new_faces = load_faces([images_list[idx]
+                                                    for idx in added],
+                                               pixels_dir)
+        if (width, height) != (bundle.width, bundle.height):
+            return None
+
+    kept = kept_components(numimgs, egfnum, bundle.fast)
+    avg, eigenfaces, evals, weights, dropped = \
+            update_eigenspace(bundle.average, bundle.eigenfaces, bundle.evals,
+                              bundle.weights, keep, new_faces, kept)
+    # Removed faces are only known up to the kept eigenfaces, account
+    # their expected residual (the mean energy left out of the basis)
+    removed = len(bundle.images_list) - len(keep)
+    residual = bundle.evals[bundle.components:].sum() / len(bundle.images_list)
+    lost = dropped + residual * removed
+    drift = bundle.drift + lost / (evals.sum() + lost or 1.0)
+    if drift > MAX_DRIFT:
+        return None
+
+    # Rows are kept images followed by added ones, sort them as names
+    rows = [bundle.images_list[idx] for idx in keep] + \
+                [names[idx] for idx in added]
+    order = [rows.index(name) for name in names]
+    return FaceBundle(bundle.directory, names, bundle.width, bundle.height,
+                      None, eigenfaces, avg, evals, labels, weights[order],
+                      drift, changed, fast=bundle.fast)
+
+
+def tuple_stamp(value):
+    """ Returns fingerprint entry `value` as an hashable value """
+    return tuple(value) if isinstance(value, list) else value
+
+
+def gallery_index(weights):
+    """ Returns an index over `weights`, see index_type """
+    return build_index(index_type(*weights.shape), weights)
+
+
+def index_type(rows, dimensions):
+    """ Returns the index name for a gallery of `rows` images projected
+    over `dimensions` eigenfaces: a compact WEIGHTS_DTYPE index if set,
+    otherwise INDEX_TYPE or an exhaustive search on galleries smaller
+    than INDEX_MIN_SIZE or with more than INDEX_MAX_DIMENSIONS """
+    if WEIGHTS_DTYPE:
+        return WEIGHTS_DTYPE
+    if rows < INDEX_MIN_SIZE or dimensions > INDEX_MAX_DIMENSIONS:
+        return BruteIndex.name
+    return INDEX_TYPE
+
+
+def save_bundle(path, bundle, stamp):
+    """ Saves `bundle`, its index and its EIGENFACES_DTYPE eigenfaces (if
+    set) at `path` with images fingerprint `stamp` """
+    fields = bundle.as_dict()
+    arrays = dict((name, fields.pop(name)) for name in BUNDLE_ARRAYS)
+    fields['fingerprint'] = stamp
+    if bundle.index is not None:
+        fields['index'] = bundle.index.name
+        for name, value in bundle.index.as_arrays().iteritems():
+            arrays[INDEX_PREFIX + name] = value
+    if EIGENFACES_DTYPE and bundle.weights is not None:
+        codes, scales = compact_eigenfaces(bundle)
+        arrays[COMPACT_PREFIX + 'codes'] = codes
+        arrays[COMPACT_PREFIX + 'scales'] = scales
+    save_cache(path, fields, arrays)
+
+
+def load_bundle(path):
+    """ Loads bundle cached at `path`, arrays are memory mapped.
+    Returns (bundle, fingerprint) or (None, None) if there's no valid
+    cache at `path` """
+    fields, arrays = load_cache(path)
+    if fields is None:
+        return None, None
+    values = dict((str(name), value) for name, value in fields.iteritems())
+    # JSON gives back unicode, paths and labels are compared as listed
+    values['directory'] = encode_name(values['directory'])
+    for name in ('images_list', 'labels'):
+        if values.get(name) is not None:
+            values[name] = map(encode_name, values[name])
+    stamp = values.pop('fingerprint')
+    index = values.pop('index', None)
+    for name in BUNDLE_ARRAYS:
+        values[name] = arrays.get(name)
+    bundle = FaceBundle(**values)
+    if index:
+        bundle.index = load_index(index, bundle.weights,
+                                  dict((str(name[len(INDEX_PREFIX):]), value)
+                                        for name, value in arrays.iteritems()
+                                            if name.startswith(INDEX_PREFIX)))
+    if COMPACT_PREFIX + 'codes' in arrays:
+        bundle.compact = (arrays[COMPACT_PREFIX + 'codes'],
+                          arrays[COMPACT_PREFIX + 'scales'])
+    return bundle, stamp
+
+
+def encode_name(name):
+    """ Returns `name` as UTF-8 bytes, as listdir returns byte string
+    paths for byte string directories """
+    return name.encode('utf-8') if isinstance(name, unicode) else name
 
 
 def parse_folder(directory, filter_rule=None):
@@ -173,6 +781,91 @@ def parse_folder(directory, filter_rule=None):
                             for name in listdir(directory))))
 
 
+def parse_gallery(directory):
+    """ Returns (images_list, labels) for gallery at `directory`, where
+    every folder is a person and holds images of that person face.
+    labels[i] is the folder name for images_list[i]. """
+    images_list, labels = [], []
+    for person in parse_folder(directory, is_person):
+        names = parse_folder(person, is_image)
+        images_list.extend(names)
+        labels.extend([basename(person)] * len(names))
+    return images_list, labels
+
+
+def is_person(name):
+    """ Returns True if `name` is a gallery person folder """
+    return isdir(name) and not basename(name).startswith('.')
+
+
+def is_image(name):
+    """ Returns True if `name` has an image file extension """
+    return name.lower().split('.')[-1] in IMAGE_EXTENSIONS
+
+
+def relative_names(directory, images_list):
+    """ Returns `images_list` paths relative to `directory` """
+    prefix = normpath(directory) + sep
+    return [name[len(prefix):] if name.startswith(prefix) else name
+                for name in images_list]
+
+
+def load_faces(images_list, pixels_dir=None, dtype=float64):
+    """ Returns (width, height, facet_matrix) for images at `images_list`,
+    each facet_matrix row holds the normalized pixels of an image as
+    `dtype`. Raises IOError if the list is empty or images sizes differ """
+    if not images_list:
+        raise IOError, 'Folder empty'
+
+    faces, sizes = [], set()
+    with STATS.timer('bundle.load_faces'):
+        for name in images_list:
+            pixels = load_pixels(name, pixels_dir)
+            faces.append(pixels.reshape(-1))
+            sizes.add(pixels.shape[::-1])
+
+    if len(sizes) > 1:
+        raise IOError, 'Select folder with all images of equal dimensions'
+    width, height = sizes.pop()
+    facet_matrix = zeros((len(faces), width * height), dtype)
+    for i, face in enumerate(faces):
+        facet_matrix[i] = face
+    return width, height, facet_matrix
+
+
+def load_pixels(name, pixels_dir=None):
+    """ Returns image `name` normalized grayscale pixels as an height x
+    width array. Decoded images are kept at `pixels_dir` keyed by path,
+    size and modification time so changed files are decoded again """
+    if pixels_dir:
+        prefix = sha1(abspath(name)).hexdigest()
+        path = join(pixels_dir, '%s-%s-%r.npy' % (prefix, getsize(name),
+                                                   getmtime(name)))
+        if exists(path):
+            try:
+                pixels = load_array(path, mmap_mode='r')
+                STATS.incr('bundle.pixels_hits')
+                return pixels
+            except (IOError, ValueError):
+                pass # damaged entry, decode again
+
+    STATS.incr('bundle.decoded')
+    img = Image.open(name).convert('L')
+    pixels = asfarray(img.getdata())
+    pixels = (pixels / max(pixels)).reshape(img.size[1], img.size[0])
+
+    if pixels_dir:
+        try:
+            if not exists(pixels_dir):
+                makedirs(pixels_dir)
+            for stale in glob(join(pixels_dir, prefix + '-*.npy')):
+                remove(stale)
+            save_array(path, pixels)
+        except (IOError, OSError):
+            pass # read-only cache, just decode every time
+    return pixels
+
+
 def validate_directory(images_list):
     """ Validates images directory, all should be images
     of the same size """
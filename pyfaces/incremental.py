@@ -0,0 +1,80 @@
+"""
+Incremental eigenspace updates.
+
+Bundles keep eigenfaces scaled by the inverse of their eigenvalue (see
+create_face_bundle) and gallery weights projected over them, so for the
+kept components:
+
+    unit basis     U = eigenfaces * sqrt(evals)
+    coefficients   C = weights * sqrt(evals)
+
+Old faces are represented by their coefficients C over U, new faces are
+projected over U plus an orthonormal basis of their residuals, and the
+mean and eigenbasis are re-estimated on that small augmented space. The
+energy dropped when truncating the augmented basis back is returned so
+callers can bound the accumulated drift and rebuild when it's too big.
+"""
+from numpy import sqrt, dot, zeros, hstack, vstack, maximum, where, \
+                  finfo
+from numpy.linalg import eigh, svd
+
+
+RESIDUAL_TOLERANCE = 1e-10
+
+
+def update_eigenspace(avg, eigenfaces, evals, weights, keep, new_faces,
+                      kept):
+    """ Updates the eigenspace with `new_faces` and without the faces not
+    in `keep`.
+
+    Parameters:
+        @avg: current average face
+        @eigenfaces: current eigenfaces (scaled as create_face_bundle does)
+        @evals: current eigenvalues, at least one per eigenface
+        @weights: current faces projected over `eigenfaces`
+        @keep: indexes of `weights` rows to keep
+        @new_faces: 2d array, each row holds normalized pixels of a face
+                    to add
+        @kept: number of eigenfaces to keep after the update
+
+    Returns:
+        (avg, eigenfaces, evals, weights, dropped)
+        @weights: rows for kept faces (in `keep` order) followed by
+                  rows for `new_faces`
+        @dropped: energy (sum of eigenvalues) left out by the update
+    """
+    components = weights.shape[1]
+    root = sqrt(maximum(evals[:components], 0))
+    basis = eigenfaces[:components] * root[:,None]
+    coeffs = weights[keep] * root
+
+    # Residuals of new faces out of the current basis extend it
+    adjusted = new_faces - avg
+    projected = dot(adjusted, basis.transpose())
+    residuals = adjusted - dot(projected, basis)
+    if len(residuals):
+        u, s, vt = svd(residuals, 0)
+        extra = vt[s > RESIDUAL_TOLERANCE * max(s.max(), 1.0)]
+    else:
+        extra = zeros((0, basis.shape[1]))
+    basis = vstack([basis, extra])
+    coeffs = vstack([hstack([coeffs, zeros((len(coeffs), len(extra)))]),
+                     hstack([projected, dot(residuals, extra.transpose())])])
+
+    # Re-center and diagonalize the scatter on the augmented space
+    center = coeffs.mean(axis=0)
+    coeffs = coeffs - center
+    avg = avg + dot(center, basis)
+    evals1, evects1 = eigh(dot(coeffs.transpose(), coeffs))
+    order = evals1.argsort()[::-1]
+    evals, evects = maximum(evals1[order], 0), evects1[:,order]
+
+    kept = min(kept, len(evals))
+    dropped = evals[kept:].sum()
+    evects = evects[:,:kept]
+    root = sqrt(evals[:kept])
+    scale = where(root > finfo(float).eps, root, 0)
+    scale[scale > 0] = 1 / scale[scale > 0]
+    eigenfaces = dot(evects.transpose(), basis) * scale[:,None]
+    weights = dot(coeffs, evects) * scale
+    return avg, eigenfaces, evals, weights, dropped
@@ -0,0 +1,272 @@
+"""
+Nearest neighbour indexes over gallery weights.
+
+Every index answers top-k queries optionally limited to a `radius`
+(the match threshold), returning [(row, distance), ...] sorted by
+distance. BruteIndex is the exact reference and the default, a single
+matrix product. KDTreeIndex prunes whole subtrees that can't hold a
+closer (or within radius) row, but it walks them one probe at a time
+and prunes little past a few dimensions: exact bundles keep half the
+images as eigenfaces, where it's several times slower.
+Float16Index and Int8Index search a compact copy of the weights (2 and
+1 bytes per value with a scale per dimension) so only the copy is read
+while searching, the RERANK * k closest candidates are then ranked on
+the exact weights.
+
+Indexes are plain arrays so they're stored in the bundle cache next to
+the weights they index (see eigenfaces.save_bundle).
+"""
+from collections import deque
+
+from numpy import arange, argsort, array, asarray, concatenate, dot, \
+                  int32, maximum, sqrt, float64, zeros, abs as absolute, \
+                  int8, float16, float32, rint
+
+from stats import STATS
+from streaming import chunks
+
+
+LEAF_SIZE = 64
+# compact candidates ranked on the exact weights per result asked, 0
+# returns the compact distances
+RERANK       = 4
+# compact rows converted to float32 at once while searching
+SEARCH_ROWS  = 4096
+
+
+class BruteIndex(object):
+    """ Exact search computing every distance """
+    name = 'brute'
+
+    def __init__(self, points, **arrays):
+        self.points = points
+
+    def as_arrays(self):
+        return {}
+
+    def query(self, point, k=1, radius=None):
+        return self.query_many(point[None,:], k, radius)[0]
+
+    def query_many(self, points, k=1, radius=None):
+        """ Returns a list of results (see query) per row in `points`,
+        distances for all of them are computed at once """
+        STATS.incr('index.comparisons', len(points) * len(self.points))
+        dist = (points ** 2).sum(axis=1)[:,None] - \
+                    2 * dot(points, self.points.transpose()) + \
+                    (self.points ** 2).sum(axis=1)[None,:]
+        dist = sqrt(maximum(dist, 0))
+        results = []
+        for row in dist:
+            if k == 1: # avoid sorting for the common case
+                nearest = [row.argmin()]
+            else:
+                nearest = argsort(row)[:k]
+            results.append([(int(idx), float(row[idx])) for idx in nearest
+                                if radius is None or row[idx] < radius])
+        return results
+
+
+class KDTreeIndex(object):
+    """ Exact search over a k-d tree, nodes split the widest dimension at
+    its median until LEAF_SIZE rows are left """
+    name = 'kdtree'
+
+    def __init__(self, points, order=None, dims=None, values=None,
+                 lefts=None, rights=None, starts=None, ends=None):
+        self.points = points
+        if order is None:
+            order, dims, values, lefts, rights, starts, ends = \
+                    self.build(points)
+        self.order, self.dims, self.values = order, dims, values
+        self.lefts, self.rights = lefts, rights
+        self.starts, self.ends = starts, ends
+
+    def as_arrays(self):
+        return {'order': self.order, 'dims': self.dims, 'values': self.values,
+                'lefts': self.lefts, 'rights': self.rights,
+                'starts': self.starts, 'ends': self.ends}
+
+    @staticmethod
+    def build(points):
+        points = asarray(points)
+        order = arange(len(points))
+        dims, values, lefts, rights, starts, ends = [], [], [], [], [], []
+        pending = deque([(0, len(points))])
+        while pending:
+            start, end = pending.popleft()
+            dims.append(-1)
+            values.append(0.0)
+            lefts.append(-1)
+            rights.append(-1)
+            starts.append(start)
+            ends.append(end)
+            if end - start <= LEAF_SIZE or not points.shape[1]:
+                continue
+            node, rows = len(dims) - 1, points[order[start:end]]
+            dim = int((rows.max(axis=0) - rows.min(axis=0)).argmax())
+            mid = (end - start) // 2
+            sorted_rows = argsort(rows[:,dim], kind='mergesort')
+            order[start:end] = order[start:end][sorted_rows]
+            dims[node] = dim
+            values[node] = float(points[order[start + mid], dim])
+            # children are appended in breadth first order
+            lefts[node] = len(dims) + len(pending)
+            rights[node] = lefts[node] + 1
+            pending.extend([(start, start + mid), (start + mid, end)])
+        return (order, array(dims, int32), array(values, float64),
+                array(lefts, int32), array(rights, int32),
+                array(starts, int32), array(ends, int32))
+
+    def query(self, point, k=1, radius=None):
+        """ Returns [(row, distance), ...] of the `k` rows closest to
+        `point` closer than `radius` (if given), sorted by distance """
+        best_rows, best_dist = arange(0), zeros(0)
+        limit = radius * radius if radius is not None else float('inf')
+        stack, compared = [(0, 0.0)], 0
+        while stack:
+            node, bound = stack.pop()
+            if bound >= limit:
+                continue
+            if self.dims[node] < 0:
+                rows = self.order[self.starts[node]:self.ends[node]]
+                compared += len(rows)
+                dist = ((self.points[rows] - point) ** 2).sum(axis=1)
+                closer = dist < limit
+                if closer.any():
+                    best_rows = concatenate([best_rows, rows[closer]])
+                    best_dist = concatenate([best_dist, dist[closer]])
+                    nearest = argsort(best_dist, kind='mergesort')[:k]
+                    best_rows, best_dist = best_rows[nearest], \
+                                           best_dist[nearest]
+                    if len(best_rows) == k:
+                        limit = best_dist[-1]
+            else:
+                diff = point[self.dims[node]] - self.values[node]
+                near, far = (self.lefts[node], self.rights[node]) \
+                                if diff < 0 else \
+                            (self.rights[node], self.lefts[node])
+                stack.append((far, max(bound, diff * diff)))
+                stack.append((near, bound))
+        STATS.incr('index.comparisons', compared)
+        return [(int(row), float(sqrt(value)))
+                    for row, value in zip(best_rows, best_dist)]
+
+    def query_many(self, points, k=1, radius=None):
+        return [self.query(point, k, radius) for point in points]
+
+
+class QuantizedIndex(object):
+    """ Search over `points` quantized to `dtype` codes, points are
+    approximately codes * scales, with a scale per dimension. Squared
+    codes norms are kept so distances take a single product """
+    name = None
+    dtype = None
+    levels = None
+
+    def __init__(self, points, codes=None, scales=None, norms=None):
+        self.points = points
+        if codes is None:
+            codes, scales = quantize(points, self.dtype, self.levels)
+            norms = (asarray(codes, float32) ** 2).dot(scales ** 2)
+        self.codes, self.scales, self.norms = codes, scales, norms
+
+    def as_arrays(self):
+        return {'codes': self.codes, 'scales': self.scales,
+                'norms': self.norms}
+
+    def query(self, point, k=1, radius=None):
+        return self.query_many(point[None,:], k, radius)[0]
+
+    def query_many(self, points, k=1, radius=None):
+        """ Returns a list of results (see query) per row in `points`,
+        compact distances for all of them are computed at once, SEARCH_ROWS
+        rows at a time """
+        points = asarray(points, float32)
+        STATS.incr('index.comparisons', len(points) * len(self.codes))
+        scaled = (points * self.scales).transpose()
+        dist = zeros((len(points), len(self.codes)), float32)
+        for part in chunks(len(self.codes), SEARCH_ROWS):
+            dist[:,part] = dot(asarray(self.codes[part], float32), scaled) \
+                                .transpose()
+        dist = (points ** 2).sum(axis=1)[:,None] - 2 * dist + \
+                    self.norms[None,:]
+        candidates = k * RERANK if RERANK else k
+        results = []
+        for point, row in zip(points, dist):
+            if candidates == 1: # avoid sorting for the common case
+                nearest = [row.argmin()]
+            else:
+                nearest = argsort(row)[:candidates]
+            if RERANK:
+                results.append(self.rerank(point, nearest, k, radius))
+            else:
+                results.append([(int(idx), float(sqrt(max(row[idx], 0))))
+                                    for idx in nearest
+                                        if radius is None or
+                                           sqrt(max(row[idx], 0)) < radius])
+        return results
+
+    def rerank(self, point, rows, k, radius):
+        """ Returns the `k` of `rows` closest to `point` on the exact
+        points, closer than `radius` if given """
+        rows = sorted(rows) # memory mapped points read in order
+        STATS.incr('index.reranked', len(rows))
+        dist = sqrt(((self.points[rows] - asarray(point, float64)) ** 2) \
+                        .sum(axis=1))
+        return [(int(rows[idx]), float(dist[idx]))
+                    for idx in argsort(dist, kind='mergesort')[:k]
+                        if radius is None or dist[idx] < radius]
+
+
+class Float16Index(QuantizedIndex):
+    """ Points as float16, scaled to [-1, 1] per dimension """
+    name = 'float16'
+    dtype = float16
+    levels = 1.0
+
+
+class Int8Index(QuantizedIndex):
+    """ Points as int8, scaled to [-127, 127] per dimension """
+    name = 'int8'
+    dtype = int8
+    levels = 127.0
+
+
+def quantize(values, dtype, levels):
+    """ Returns (codes, scales) for `values` as `dtype` codes with a scale
+    per column, the largest absolute value of every column is coded as
+    `levels` """
+    values = asarray(values, float64)
+    scales = absolute(values).max(axis=0) / levels if len(values) else \
+                zeros(values.shape[1])
+    scales[scales == 0] = 1.0
+    codes = values / scales
+    if dtype(0).dtype.kind == 'i':
+        codes = rint(codes)
+    return codes.astype(dtype), scales.astype(float32)
+
+
+INDEXES = dict((index.name, index) for index in (BruteIndex, KDTreeIndex,
+                                                 Float16Index, Int8Index))
+
+
+def build(name, points):
+    """ Builds index `name` over `points` rows """
+    return INDEXES[name](points)
+
+
+def load(name, points, arrays):
+    """ Loads index `name` over `points` from its `arrays` """
+    return INDEXES[name](points, **arrays)
+
+
+def recall(index, queries, k=1, radius=None):
+    """ Returns the fraction of exact (BruteIndex) results for `queries`
+    that `index` also returns """
+    exact = BruteIndex(index.points).query_many(queries, k, radius)
+    found = index.query_many(queries, k, radius)
+    total = sum(len(result) for result in exact)
+    hits = sum(len(set(row for row, dist in expected) &
+                   set(row for row, dist in result))
+                    for expected, result in zip(exact, found))
+    return float(hits) / total if total else 1.0
@@ -0,0 +1,193 @@
+"""
+Results cache keyed by content.
+
+Detection boxes and match results are kept under a digest of the
+image (or crop) contents and the parameters that produced them, so
+re-uploads, copies and reprocessing runs skip the work. Values are kept
+in memory (least recently used first out, `max_items`) and, if a
+`directory` is set, as JSON files there, removing the oldest files
+once they take more than `max_bytes`.
+
+Entries live in a namespace: detection parameters for boxes, the
+bundle version for matches. Namespaces of rebuilt bundles are dropped
+(see eigenfaces.get_bundle) and keys of new bundles never match them.
+
+MEMO is the process wide cache used by detect and pyfaces, disabled by
+default:
+
+    from pyfaces.memo import MEMO
+    MEMO.enabled = True
+    MEMO.directory = '/var/cache/faces'
+"""
+import os, json, shutil, tempfile, threading
+from collections import OrderedDict
+from hashlib import sha1
+from os.path import exists, getsize, isdir, join
+
+from numpy import ndarray, ascontiguousarray
+
+from stats import STATS
+
+
+MAX_ITEMS  = 10000
+MAX_BYTES  = 64 * 1024 * 1024
+HASH_BLOCK = 1024 * 1024
+
+
+class Memo(object):
+    """ Two tiers (memory and disk) results cache """
+    def __init__(self, enabled=False, directory=None, max_items=MAX_ITEMS,
+                 max_bytes=MAX_BYTES):
+        self.enabled = enabled
+        self.directory = directory
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.disk_bytes = None # computed on first write
+
+    def get(self, namespace, key):
+        """ Returns the value for `key` at `namespace` or None """
+        if not self.enabled:
+            return None
+        with self.lock:
+            value = self.items.pop((namespace, key), None)
+            if value is not None:
+                self.items[(namespace, key)] = value # most recently used
+                STATS.incr('memo.hits')
+                return value
+        value = self.read(namespace, key)
+        if value is None:
+            STATS.incr('memo.misses')
+            return None
+        STATS.incr('memo.disk_hits')
+        self.remember(namespace, key, value)
+        return value
+
+    def put(self, namespace, key, value):
+        """ Stores JSON serializable `value` for `key` at `namespace` """
+        if not self.enabled:
+            return
+        self.remember(namespace, key, value)
+        self.write(namespace, key, value)
+
+    def remember(self, namespace, key, value):
+        with self.lock:
+            self.items.pop((namespace, key), None)
+            self.items[(namespace, key)] = value
+            while len(self.items) > self.max_items:
+                self.items.popitem(last=False)
+
+    def invalidate(self, namespace):
+        """ Drops every entry at `namespace` """
+        with self.lock:
+            for item in [item for item in self.items
+                                if item[0] == namespace]:
+                del self.items[item]
+        if self.directory and isdir(join(self.directory, namespace)):
+            shutil.rmtree(join(self.directory, namespace),
+                          ignore_errors=True)
+            self.disk_bytes = None
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def path(self, namespace, key):
+        return join(self.directory, namespace, key + '.json')
+
+    def read(self, namespace, key):
+        if not self.directory:
+            return None
+        try:
+            with open(self.path(namespace, key)) as entry:
+                return json.load(entry)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def write(self, namespace, key, value):
+        """ Writes the entry to disk, evicting the oldest files if needed.
+        Disk failures only lose the disk tier """
+        if not self.directory:
+            return
+        path = self.path(namespace, key)
+        try:
+            folder = join(self.directory, namespace)
+            if not exists(folder):
+                os.makedirs(folder)
+            fd, temp = tempfile.mkstemp(dir=folder)
+            with os.fdopen(fd, 'w') as entry:
+                json.dump(value, entry)
+            os.rename(temp, path)
+            if self.disk_bytes is None:
+                self.disk_bytes = sum(size for mtime, size, name
+                                            in self.entries())
+            else:
+                self.disk_bytes += getsize(path)
+            if self.disk_bytes > self.max_bytes:
+                self.evict()
+        except (IOError, OSError):
+            pass
+
+    def entries(self):
+        """ Returns [(mtime, size, path), ...] for every disk entry """
+        entries = []
+        for root, folders, names in os.walk(self.directory):
+            for name in names:
+                path = join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def evict(self):
+        """ Removes the oldest disk entries until they take at most 3/4
+        of max_bytes, so eviction doesn't run on every write """
+        entries = sorted(self.entries())
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in entries:
+            if total <= self.max_bytes * 3 / 4:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                STATS.incr('memo.evictions')
+            except OSError:
+                pass
+        self.disk_bytes = total
+
+
+def content_key(image, *parameters):
+    """ Returns a digest of `image` contents (a path, an open file, a PIL
+    image or an array) and `parameters` """
+    digest = sha1(repr(parameters))
+    if isinstance(image, basestring):
+        with open(image, 'rb') as source:
+            update_digest(digest, source)
+    elif hasattr(image, 'read'):
+        position = image.tell()
+        update_digest(digest, image)
+        image.seek(position)
+    elif isinstance(image, ndarray):
+        digest.update(repr((image.shape, image.dtype.str)))
+        digest.update(ascontiguousarray(image).data)
+    else: # PIL image
+        digest.update(repr((image.size, image.mode)))
+        digest.update(image.tobytes() if hasattr(image, 'tobytes')
+                                      else image.tostring())
+    return digest.hexdigest()
+
+
+def update_digest(digest, source):
+    for block in iter(lambda: source.read(HASH_BLOCK), ''):
+        digest.update(block)
+
+
+def parameters_key(*parameters):
+    """ Returns a namespace name for `parameters` """
+    return sha1(repr(parameters)).hexdigest()
+
+
+MEMO = Memo()
@@ -1,7 +1,4 @@
-import sys, optparse, Image
-
-from eigenfaces import find_matching_image, parse_folder
-from utils import merge_images
+import sys, optparse
 
 
 FACES     = None
@@ -18,7 +15,8 @@ class PyFaces(object):
                  resize=True):
         """ Init method
         Parameters:
-            @image: Image with a face
+            @image: Image with a face, or a list of them to match all
+                    at once
             @directory: Directory containing probe images
             @faces: Number of faces to compare (defaults to all images
                     in derectory)
@@ -34,21 +32,52 @@ class PyFaces(object):
         self.resize = resize
 
     def match(self):
-        """ Returns the match image and the distance between them, if any. """
+        """ Returns the match image and the distance between them, if any.
+        Returns a list of them if `image` is a list. """
+        # numpy and PIL are imported on first use, so importing this
+        # module (for THRESHOLD for example) is cheap
+        from eigenfaces import find_matching_image, find_matching_images
+        if isinstance(self.image, (list, tuple)):
+            return find_matching_images(self.image, self.directory,
+                                        self.threshold, self.faces,
+                                        self.resize)
         return find_matching_image(self.image, self.directory, self.threshold,
                                    self.faces, self.resize)
 
+    def who(self):
+        """ Returns the distance, match image and person name treating
+        `directory` as a gallery with a folder per person, if any.
+        Returns a list of them if `image` is a list. """
+        from eigenfaces import find_matching_person, find_matching_people
+        if isinstance(self.image, (list, tuple)):
+            return find_matching_people(self.image, self.directory,
+                                        self.threshold, self.faces,
+                                        self.resize)
+        return find_matching_person(self.image, self.directory,
+                                    self.threshold, self.faces, self.resize)
+
     def show(self):
-        """ Shows the matching images joined """
-        dist, match = self.match()
-        if match is not None:
-            merge_images([self.image, match]).show()
-        return dist, match
+        """ Shows the matching images joined, returns match() result. A
+        joined image is shown per matching image if `image` is a list. """
+        from utils import merge_images
+        if not isinstance(self.image, (list, tuple)):
+            dist, match = self.match()
+            if match is not None:
+                merge_images([self.image, match]).show()
+            return dist, match
+        matches = self.match()
+        for image, (dist, match) in zip(self.image, matches):
+            if match is not None:
+                merge_images([image, match]).show()
+        return matches
 
 
 if __name__ == '__main__':
+    import cache
+    from utils import merge_images
+
     parser = optparse.OptionParser()
-    parser.add_option('-i', '--image', dest='image')
+    parser.add_option('-i', '--image', action='append', dest='image')
     parser.add_option('-d', '--directory', dest='directory')
     parser.add_option('-f', '--faces', type='int', default=FACES, dest='faces')
     parser.add_option('-t', '--threshold', type='float', default=THRESHOLD,
@@ -57,7 +86,12 @@ if __name__ == '__main__':
                       dest='show')
     parser.add_option('-r', '--resize', default=True, action='store_true',
                       dest='resize')
+    parser.add_option('-g', '--gallery', default=False, action='store_true',
+                      dest='gallery')
+    parser.add_option('-c', '--cache-dir', default=cache.CACHE_DIR,
+                      dest='cache_dir')
     (options, args) = parser.parse_args()
+    cache.CACHE_DIR = options.cache_dir
 
     if not options.image or not options.directory:
         parser.print_help()
@@ -66,11 +100,15 @@ if __name__ == '__main__':
     pyfaces = PyFaces(options.image, options.directory,
                       options.faces, options.threshold,
                       options.resize)
-    if options.show:
-        dist, match = pyfaces.show()
+    if options.gallery:
+        for image, (dist, match, person) in zip(options.image, pyfaces.who()):
+            if match is not None:
+                print 'The image "%s" matches "%s" (%s) with a distance of ' \
+                      '"%s"' % (image, person, match, dist)
     else:
-        dist, match = pyfaces.match()
-
-    if match is not None:
-        print 'The image "%s" matches "%s" with a distance of "%s"' % \
-                    (options.image, match, dist)
+        for image, (dist, match) in zip(options.image, pyfaces.match()):
+            if match is not None:
+                if options.show:
+                    merge_images([image, match]).show()
+                print 'The image "%s" matches "%s" with a distance of "%s"' % \
+                            (image, match, dist)
@@ -0,0 +1,121 @@
+"""
+Timings and counters for faces detection and recognition stages.
+
+STATS is the process wide Stats instance used by detect and pyfaces,
+it's disabled by default so instrumented code only pays a method call:
+
+    from pyfaces.stats import STATS
+    STATS.enabled = True
+    ...
+    print STATS.report()
+
+Hooks registered with add_hook are called as hook(kind, name, value)
+for every recorded value, kind is 'time' (value in seconds) or 'count',
+to forward them to other collectors. Values recorded by worker
+processes (see detect.batch) stay in those processes.
+"""
+import threading
+from timeit import default_timer
+
+
+class Timer(object):
+    """ Context manager adding the time spent in its block to `name` """
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = default_timer()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stats.add_time(self.name, default_timer() - self.start)
+        return False
+
+
+class NullTimer(object):
+    """ Timer used when stats are disabled """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class Stats(object):
+    """ Thread safe stages wall times and counters """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.hooks = []
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """ Clears recorded values """
+        with self.lock:
+            self.times = {}
+            self.counters = {}
+
+    def timer(self, name):
+        """ Returns a context manager timing its block as stage `name` """
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self, name)
+
+    def add_time(self, name, seconds):
+        """ Adds `seconds` spent on stage `name` """
+        if not self.enabled:
+            return
+        with self.lock:
+            calls, total = self.times.get(name, (0, 0.0))
+            self.times[name] = (calls + 1, total + seconds)
+        self.notify('time', name, seconds)
+
+    def incr(self, name, value=1):
+        """ Increments counter `name` by `value` """
+        if not self.enabled or not value:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        self.notify('count', name, value)
+
+    def add_hook(self, hook):
+        """ Calls hook(kind, name, value) on every recorded value """
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def notify(self, kind, name, value):
+        for hook in self.hooks:
+            hook(kind, name, value)
+
+    def snapshot(self):
+        """ Returns recorded values as a dict:
+            {'times': {name: {'calls': n, 'total': seconds}, ...},
+             'counters': {name: value, ...}}
+        """
+        with self.lock:
+            return {'times': dict((name, {'calls': calls, 'total': total})
+                                    for name, (calls, total)
+                                        in self.times.iteritems()),
+                    'counters': dict(self.counters)}
+
+    def report(self):
+        """ Returns recorded values as a printable table """
+        values = self.snapshot()
+        lines = ['%-28s %8s %10s' % ('stage', 'calls', 'seconds')]
+        for name, value in sorted(values['times'].iteritems()):
+            lines.append('%-28s %8d %10.4f' % (name, value['calls'],
+                                               value['total']))
+        lines.append('')
+        lines.append('%-28s %8s' % ('counter', 'value'))
+        for name, value in sorted(values['counters'].iteritems()):
+            lines.append('%-28s %8d' % (name, value))
+        return '\n'.join(lines)
+
+
+STATS = Stats()
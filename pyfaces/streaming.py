@@ -0,0 +1,224 @@
+"""
+Out of core eigenspace building.
+
+Galleries whose faces don't fit in MAX_MEMORY bytes are decoded one
+image at a time into a facet matrix backed by a temporary file, the
+mean is accumulated while decoding and every product over the faces is
+computed chunk by chunk, so at most a couple of chunks of faces are in
+memory. Eigenfaces and gallery weights too big for memory are backed
+by temporary files too.
+
+Exact builds decompose a scatter matrix: the images Gram matrix
+(images x images) or, on galleries with more images than pixels, the
+pixels covariance. It and its eigenvectors must fit in MAX_MEMORY, or
+IOError is raised. Fast training with less eigenfaces than images uses
+a randomized SVD instead (see randomized), which only keeps a few
+values per image and pixel, so its memory is bounded by the number of
+eigenfaces.
+
+MAX_MEMORY defaults to the PYFACES_MAX_MEMORY environment variable
+(bytes) or 256MB.
+"""
+import os, tempfile
+
+from numpy import dot, float64, memmap, sqrt, zeros, maximum, finfo, \
+                  dtype as np_dtype
+from numpy.linalg import eigh, qr, svd
+from numpy.random import RandomState
+
+
+MAX_MEMORY = int(os.environ.get('PYFACES_MAX_MEMORY', 256 * 1024 * 1024))
+# in memory builds hold about this many copies of the faces
+MEMORY_COPIES = 3
+# the scatter matrix, its eigenvectors and eigh workspace
+SCATTER_COPIES = 3
+
+
+def fits_memory(numimgs, pixels, dtype, max_memory=None):
+    """ Returns True if an in memory build of `numimgs` faces with
+    `pixels` pixels each fits in `max_memory` (MAX_MEMORY by default) """
+    if max_memory is None:
+        max_memory = MAX_MEMORY
+    return MEMORY_COPIES * numimgs * pixels * dtype(0).itemsize <= max_memory
+
+
+def chunk_rows(pixels, dtype, max_memory=None):
+    """ Returns how many faces of `pixels` pixels are processed at once,
+    two chunks and their mean adjusted copies fit in `max_memory` """
+    if max_memory is None:
+        max_memory = MAX_MEMORY
+    return max(1, max_memory // (4 * pixels * dtype(0).itemsize))
+
+
+def chunks(count, rows):
+    """ Yields slices of `rows` rows covering `count` rows """
+    for start in xrange(0, count, rows):
+        yield slice(start, min(start + rows, count))
+
+
+def scratch(shape, dtype, max_memory, directory=None):
+    """ Returns a zeroed array of `shape`, a memmap over a temporary file
+    at `directory` (system temporary directory by default) unless it
+    fits in `max_memory` bytes """
+    if shape[0] * shape[1] * np_dtype(dtype).itemsize <= max_memory:
+        return zeros(shape, dtype)
+    fd, path = tempfile.mkstemp(suffix='.scratch', dir=directory)
+    try:
+        return memmap(path, dtype, 'w+', shape=shape)
+    finally:
+        os.close(fd)
+        os.remove(path) # the mapping keeps the file alive
+
+
+def load_facets(images_list, load, dtype=float64, max_memory=None,
+                directory=None):
+    """ Decodes images at `images_list` one by one with `load` (which
+    returns an height x width pixels array), checking they have the same
+    size. The facet matrix is kept in memory if it fits in half
+    `max_memory`, see scratch. Returns (width, height, facets, avg),
+    raises IOError on the first image with a different size """
+    if not images_list:
+        raise IOError, 'Folder empty'
+    if max_memory is None:
+        max_memory = MAX_MEMORY
+
+    first = load(images_list[0])
+    height, width = first.shape
+    shape = (len(images_list), width * height)
+    facets = scratch(shape, dtype, max_memory / 2, directory)
+
+    total = zeros(shape[1], float64)
+    for i, name in enumerate(images_list):
+        pixels = first if i == 0 else load(name)
+        if pixels.shape != (height, width):
+            raise IOError, 'Select folder with all images of equal dimensions'
+        facets[i] = pixels.reshape(-1)
+        total += facets[i]
+    return width, height, facets, (total / shape[0]).astype(dtype)
+
+
+def fits_scatter(numimgs, pixels, max_memory=None):
+    """ Returns True if the scatter matrix of `numimgs` faces of `pixels`
+    pixels can be decomposed in `max_memory` (MAX_MEMORY by default) """
+    if max_memory is None:
+        max_memory = MAX_MEMORY
+    size = min(numimgs, pixels)
+    return SCATTER_COPIES * size * size * 8 <= max_memory
+
+
+def eigenspace(facets, avg, kept, rows, max_memory=None):
+    """ Returns (eigenfaces, evals) for the top `kept` components of
+    `facets` rows adjusted by `avg`, reading `rows` faces at a time.
+    Eigenfaces are scaled as create_face_bundle does, kept in memory if
+    they fit in a quarter of `max_memory` (see scratch), evals holds
+    every eigenvalue of the scatter sorted in decreasing order. Raises
+    IOError if the scatter doesn't fit in `max_memory` """
+    if max_memory is None:
+        max_memory = MAX_MEMORY
+    numimgs, pixels = facets.shape
+    kept = min(kept, numimgs, pixels)
+    if not fits_scatter(numimgs, pixels, max_memory):
+        raise IOError, 'Gallery too big to build %d eigenfaces in %d ' \
+                       'bytes, raise PYFACES_MAX_MEMORY or use fast ' \
+                       'training' % (kept, max_memory)
+    eigen_space = scratch((kept, pixels), facets.dtype, max_memory / 4)
+    if numimgs <= pixels:
+        evals, evects = decreasing(eigh(gram(facets, avg, rows)))
+        # eigenfaces are the faces combined by the Gram eigenvectors,
+        # accumulated `rows` eigenfaces at a time
+        for part in chunks(numimgs, rows):
+            adjusted = facets[part] - avg
+            for block in chunks(kept, rows):
+                eigen_space[block] += dot(evects[part,block].transpose(),
+                                          adjusted)
+        for block in chunks(kept, rows):
+            eigen_space[block] /= maximum((eigen_space[block] ** 2) \
+                                                .sum(axis=1),
+                                          finfo(facets.dtype).eps)[:,None]
+    else:
+        evals, evects = decreasing(eigh(covariance(facets, avg, rows)))
+        root = sqrt(maximum(evals[:kept], finfo(facets.dtype).eps))
+        eigen_space[:] = (evects[:,:kept] / root).transpose()
+    return eigen_space, evals
+
+
+def randomized(facets, avg, kept, rows, oversamples, iterations, seed):
+    """ Returns (components, evals, energy) for `facets` rows adjusted by
+    `avg` reading `rows` faces at a time: the top `kept` principal
+    components as unit rows, their eigenvalues and the energy of every
+    component. Components come from a randomized SVD over `kept` plus
+    `oversamples` random directions refined by `iterations` power
+    iterations, as eigenfaces.fast_eigenspace does in memory """
+    numimgs, pixels = facets.shape
+    sample = RandomState(seed).standard_normal((pixels, kept + oversamples)) \
+                .astype(facets.dtype)
+    basis, r = qr(product(facets, avg, sample, rows))
+    for i in xrange(iterations):
+        basis, r = qr(transposed_product(facets, avg, basis, rows))
+        basis, r = qr(product(facets, avg, basis, rows))
+    u, values, vt = svd(transposed_product(facets, avg, basis, rows) \
+                            .transpose(), 0)
+    energy = sum(float(((facets[part] - avg).astype(float64) ** 2).sum())
+                    for part in chunks(numimgs, rows))
+    return vt[:kept], values[:kept] ** 2, energy
+
+
+def product(facets, avg, matrix, rows):
+    """ Returns mean adjusted `facets` times `matrix`, products are done
+    in the faces type """
+    matrix = matrix.astype(facets.dtype)
+    result = zeros((len(facets), matrix.shape[1]), float64)
+    for part in chunks(len(facets), rows):
+        result[part] = dot(facets[part] - avg, matrix)
+    return result
+
+
+def transposed_product(facets, avg, matrix, rows):
+    """ Returns mean adjusted `facets` transposed times `matrix`,
+    products are done in the faces type """
+    matrix = matrix.astype(facets.dtype)
+    result = zeros((facets.shape[1], matrix.shape[1]), float64)
+    for part in chunks(len(facets), rows):
+        result += dot((facets[part] - avg).transpose(), matrix[part])
+    return result
+
+
+def decreasing((evals, evects)):
+    """ Returns eigh results sorted by decreasing eigenvalue """
+    order = evals.argsort()[::-1]
+    return maximum(evals[order], 0), evects[:,order]
+
+
+def gram(facets, avg, rows):
+    """ Returns the Gram matrix of mean adjusted `facets` """
+    numimgs = len(facets)
+    scatter = zeros((numimgs, numimgs), float64)
+    for first in chunks(numimgs, rows):
+        adjusted = facets[first] - avg
+        for second in chunks(first.stop, rows):
+            block = dot(adjusted, (facets[second] - avg).transpose())
+            scatter[first, second] = block
+            scatter[second, first] = block.transpose()
+    return scatter
+
+
+def covariance(facets, avg, rows):
+    """ Returns the pixels scatter matrix of mean adjusted `facets` """
+    pixels = facets.shape[1]
+    scatter = zeros((pixels, pixels), float64)
+    for part in chunks(len(facets), rows):
+        adjusted = facets[part] - avg
+        scatter += dot(adjusted.transpose(), adjusted)
+    return scatter
+
+
+def project(facets, avg, eigen_space, rows, max_memory=None):
+    """ Returns mean adjusted `facets` projected over `eigen_space`, kept
+    in memory if they fit in a quarter of `max_memory` (see scratch) """
+    if max_memory is None:
+        max_memory = MAX_MEMORY
+    weights = scratch((len(facets), len(eigen_space)), eigen_space.dtype,
+                      max_memory / 4)
+    for part in chunks(len(facets), rows):
+        weights[part] = dot(facets[part] - avg, eigen_space.transpose())
+    return weights
@@ -0,0 +1,248 @@
+#!/usr/bin/python
+"""
+Faces service, keeps people galleries and the face detector warm in a
+long running process and serves requests over a Unix socket (or a
+localhost TCP port). Requests and responses are JSON objects, one per
+line, several requests can be sent over the same connection:
+
+    {"command": "recognize", "image": path, "faces": dir, "people": dir,
+     "threshold": 0.5}
+        -> {"people": [[name, match, distance], ...]}
+    {"command": "extract", "image": path, "faces": dir}
+        -> {"faces": [path, ...]}
+    {"command": "detect", "image": path}
+        -> {"boxes": [[[x1, y1], [x2, y2]], ...]}
+
+Failures are answered with {"error": message}. client.py is a thin
+client with the same options as faces.py.
+"""
+import sys
+import json
+import stat
+import time
+import optparse
+import threading
+import SocketServer
+from multiprocessing.pool import ThreadPool
+from os import listdir, lstat, remove
+from os.path import abspath, exists, getmtime, isdir, join
+
+from client import DEFAULT_SOCKET, LOCALHOST
+from faces import find_people, PEOPLE_DIRECTORY
+from detect.extract import extract
+from detect.facedetect import detect
+from pyfaces.eigenfaces import get_gallery_bundle
+from pyfaces.pyfaces import THRESHOLD
+from pyfaces.memo import MEMO
+from pyfaces import cache, eigenfaces
+
+
+WORKERS        = 4
+CHECK_INTERVAL = 1.0 # seconds between gallery folders checks
+
+
+class Gallery(object):
+    """ People gallery kept in memory. Folders modification times are
+    checked at most every CHECK_INTERVAL seconds and the bundle is updated
+    (incrementally, see eigenfaces.get_bundle) when people or their
+    images are added, removed or renamed """
+    def __init__(self, directory):
+        self.directory = directory
+        self.stamp = None
+        self.checked = None
+        self.current = None
+        self.lock = threading.Lock()
+
+    def folders_stamp(self):
+        """ Returns the gallery and watched people folders modification
+        times """
+        names = [self.directory] + [join(self.directory, name)
+                                        for name in listdir(self.directory)
+                                            if not name.startswith('.') and
+                                               self.watched(name)]
+        return [(name, getmtime(name)) for name in names if isdir(name)]
+
+    def watched(self, name):
+        """ Returns True if person folder `name` is part of the bundle """
+        return True
+
+    def bundle(self):
+        """ Returns the gallery bundle, reloaded if folders changed """
+        with self.lock:
+            now = time.time()
+            if self.checked is None or now - self.checked >= CHECK_INTERVAL:
+                if self.checked is None or self.stamp != self.folders_stamp():
+                    self.current = self.load()
+                    # taken after loading, building caches touches the
+                    # gallery
+                    self.stamp = self.folders_stamp()
+                self.checked = now
+            return self.current
+
+    def load(self):
+        """ Builds or retrieves the gallery bundle """
+        return get_gallery_bundle(self.directory)
+
+
+class Service(object):
+    """ Answers requests, work is done on a fixed pool of `workers`
+    threads so each one loads the detection cascades only once. The
+    default gallery is split across `shards` processes if given (see
+    shards.ShardedGallery) """
+    def __init__(self, people=PEOPLE_DIRECTORY, workers=WORKERS, shards=None):
+        self.people = abspath(people)
+        self.galleries = {}
+        self.lock = threading.Lock()
+        self.sharded = None
+        if shards: # forked before starting any thread
+            from shards import ShardedGallery # imports this module
+            self.sharded = ShardedGallery(self.people, shards)
+        self.pool = ThreadPool(workers)
+        if not shards:
+            self.gallery(self.people).bundle() # warm up default gallery
+
+    def gallery(self, directory):
+        """ Returns the Gallery for `directory` """
+        with self.lock:
+            if directory not in self.galleries:
+                self.galleries[directory] = Gallery(directory)
+            return self.galleries[directory]
+
+    def handle(self, request):
+        """ Runs `request` on the workers pool, returns the response """
+        return self.pool.apply(self.dispatch, (request,))
+
+    def dispatch(self, request):
+        command, image = request.get('command'), request.get('image')
+        if not image:
+            raise ValueError, 'Missing image'
+
+        if command == 'recognize' and self.sharded and \
+           abspath(request.get('people') or self.people) == self.people:
+            from shards import find_people_sharded
+            return {'people': find_people_sharded(image, request.get('faces'),
+                                                  self.sharded,
+                                                  request.get('threshold',
+                                                              THRESHOLD))}
+        elif command == 'recognize':
+            gallery = self.gallery(request.get('people') or self.people)
+            people = find_people(image, request.get('faces'),
+                                 gallery.directory,
+                                 request.get('threshold', THRESHOLD),
+                                 gallery.bundle())
+            return {'people': people}
+        elif command == 'extract':
+            return {'faces': extract(image, request['faces'])}
+        elif command == 'detect':
+            return {'boxes': detect(image)}
+        raise ValueError, 'Unknown command "%s"' % command
+
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+    """ Reads JSON requests, one per line, answering each one """
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            try:
+                response = self.server.service.handle(json.loads(line))
+            except Exception, e:
+                response = {'error': str(e)}
+            self.wfile.write(json.dumps(response) + '\n')
+            self.wfile.flush()
+
+
+class UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class TCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve(service, address=DEFAULT_SOCKET):
+    """ Serves `service` forever at `address`, a Unix socket path or a
+    localhost TCP port. Raises IOError if `address` path exists and isn't
+    a socket """
+    if isinstance(address, int):
+        server = TCPServer((LOCALHOST, address), RequestHandler)
+    else:
+        if exists(address) and not remove_socket(address):
+            raise IOError, '%s exists and is not a socket' % address
+        server = UnixServer(address, RequestHandler)
+    server.service = service
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if not isinstance(address, int):
+            remove_socket(address)
+
+
+def remove_socket(path):
+    """ Removes `path` if it's a socket (left by a previous run), other
+    files are never removed. Returns True if it was removed """
+    try:
+        if not stat.S_ISSOCK(lstat(path).st_mode):
+            return False
+        remove(path)
+    except OSError:
+        return False
+    return True
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('-p', '--people', default=PEOPLE_DIRECTORY,
+                      dest='people')
+    parser.add_option('-S', '--socket', default=DEFAULT_SOCKET, dest='socket')
+    parser.add_option('-P', '--port', type='int', default=None, dest='port')
+    parser.add_option('-w', '--workers', type='int', default=WORKERS,
+                      dest='workers')
+    parser.add_option('-n', '--shards', type='int', default=None,
+                      dest='shards', help='split the default gallery across '
+                                          'this many processes')
+    parser.add_option('--face-space-threshold', type='float', default=None,
+                      dest='face_space_threshold',
+                      help='reject faces farther than this from face space '
+                           '(0 to 1) without matching them')
+    parser.add_option('--weights-dtype', type='choice',
+                      choices=['float16', 'int8'], dest='weights_dtype',
+                      help='search gallery weights stored as this type')
+    parser.add_option('--eigenfaces-dtype', type='choice',
+                      choices=['float16', 'int8'], dest='eigenfaces_dtype',
+                      help='project faces over eigenfaces stored as this '
+                           'type')
+    parser.add_option('--memo', default=False, action='store_true',
+                      dest='memo', help='cache detections and matches by '
+                                        'image contents')
+    parser.add_option('--memo-dir', dest='memo_dir',
+                      help='keep cached detections and matches at this '
+                           'directory too (implies --memo)')
+    parser.add_option('--fast-training', default=False, action='store_true',
+                      dest='fast_training',
+                      help='build galleries in float32 computing only the '
+                           'kept eigenfaces')
+    parser.add_option('--fast-components', type='int',
+                      default=eigenfaces.FAST_COMPONENTS,
+                      dest='fast_components',
+                      help='eigenfaces kept by --fast-training builds')
+    parser.add_option('-c', '--cache-dir', default=cache.CACHE_DIR,
+                      dest='cache_dir')
+    (options, args) = parser.parse_args()
+    cache.CACHE_DIR = options.cache_dir
+    MEMO.enabled = options.memo or bool(options.memo_dir)
+    MEMO.directory = options.memo_dir
+    eigenfaces.FACE_SPACE_THRESHOLD = options.face_space_threshold
+    eigenfaces.WEIGHTS_DTYPE = options.weights_dtype
+    eigenfaces.EIGENFACES_DTYPE = options.eigenfaces_dtype
+    eigenfaces.FAST_TRAINING = options.fast_training
+    eigenfaces.FAST_COMPONENTS = options.fast_components
+
+    service = Service(options.people, options.workers, options.shards)
+    try:
+        serve(service, options.port or options.socket)
+    except KeyboardInterrupt:
+        sys.exit(0)
+    finally:
+        if service.sharded:
+            service.sharded.close()
@@ -0,0 +1,195 @@
+#!/usr/bin/python
+"""
+Sharded people galleries.
+
+Galleries with thousands of people are split across `shards` worker
+processes, each one builds (or loads from its own cache file) and keeps
+the bundle of its people only. Queries are sent to every shard at once
+and the best match per face is taken across shards, so the query time
+is bounded by the largest shard and no process holds the whole gallery.
+
+People are assigned to shards by a digest of their folder name, adding
+or removing a person only changes (and updates) a single shard bundle.
+Every shard is its own eigenspace and its weights are scaled by its own
+eigenvalues, so distances from different shards aren't strictly
+comparable: the closest match across shards is an approximation of the
+one a single gallery bundle finds.
+
+    gallery = ShardedGallery('people', 8)
+    print find_people_sharded('photo.jpg', None, gallery, THRESHOLD)
+    gallery.close()
+"""
+import sys
+import optparse
+from zlib import crc32
+from os.path import basename
+from multiprocessing import Pool, cpu_count
+
+from numpy import asarray
+
+from detect.extract import extract_faces, save_faces
+from faces import reduce_result, PEOPLE_DIRECTORY
+from service import Gallery
+from pyfaces.eigenfaces import get_bundle, parse_gallery, match_bundle, \
+                               GALLERY_FILE_NAME
+from pyfaces.pyfaces import THRESHOLD
+from pyfaces.stats import STATS
+from pyfaces import cache
+
+
+SHARD_FILE_FORMAT = 'shard-%d-of-%d.' + GALLERY_FILE_NAME
+
+
+class Shard(Gallery):
+    """ The people at `directory` gallery assigned to `shard` of `shards`,
+    reloaded as Gallery does when the gallery folder or its own people
+    folders change """
+    def __init__(self, directory, shard, shards):
+        super(Shard, self).__init__(directory)
+        self.shard = shard
+        self.shards = shards
+
+    def watched(self, name):
+        return shard_of(name, self.shards) == self.shard
+
+    def load(self):
+        images_list, labels = shard_gallery(self.directory, self.shard,
+                                            self.shards)
+        if not images_list:
+            return None
+        return get_bundle(self.directory, images_list, labels,
+                          SHARD_FILE_FORMAT % (self.shard, self.shards))
+
+
+class ShardedGallery(object):
+    """ People gallery at `directory` split across `shards` processes
+    (defaults to the number of cores) """
+    def __init__(self, directory, shards=None):
+        self.directory = directory
+        self.shards = shards or cpu_count()
+        # a single process per pool pins every shard to its process
+        self.pools = [Pool(1, _start_shard, (directory, shard, self.shards))
+                        for shard in xrange(self.shards)]
+        # build or load shards concurrently, bundles stay in the shards
+        warmups = [pool.apply_async(_warm_shard) for pool in self.pools]
+        for warmup in warmups:
+            warmup.get()
+
+    def match(self, faces, threshold):
+        """ Matches `faces` (2d grayscale arrays) on every shard at once.
+
+        Returns:
+            [(mindist, image, person), ...] the closest match across
+            shards per face in `faces`, (None, None, None) for faces with
+            no match
+        """
+        if not faces:
+            return []
+        queries = [pool.apply_async(_match_shard, (faces, threshold))
+                        for pool in self.pools]
+        best = [(None, None, None)] * len(faces)
+        with STATS.timer('shards.wait'):
+            for query in queries:
+                best = [closest(current, found)
+                            for current, found in zip(best, query.get())]
+        return best
+
+    def close(self):
+        """ Stops the shards processes once they finish their queries """
+        for pool in self.pools:
+            pool.close()
+        for pool in self.pools:
+            pool.join()
+
+
+def closest(first, second):
+    """ Returns the closest of two (dist, image, person) matches """
+    if second[1] is None or (first[1] is not None and first[0] <= second[0]):
+        return first
+    return second
+
+
+def shard_of(person, shards):
+    """ Returns the shard holding `person` folder """
+    return (crc32(person) & 0xffffffff) % shards
+
+
+def shard_gallery(directory, shard, shards):
+    """ Returns (images_list, labels) as parse_gallery does but only for
+    people assigned to `shard` """
+    images_list, labels = parse_gallery(directory)
+    kept = [i for i, label in enumerate(labels)
+                if shard_of(label, shards) == shard]
+    return [images_list[i] for i in kept], [labels[i] for i in kept]
+
+
+_SHARD = []
+
+
+def _start_shard(directory, shard, shards):
+    """ Pool initializer, the shard bundle is loaded on the first query """
+    _SHARD.append(Shard(directory, shard, shards))
+
+
+def _shard_bundle():
+    return _SHARD[0].bundle()
+
+
+def _warm_shard():
+    """ Builds or loads this process shard bundle, returns True if the
+    shard holds any image """
+    return _shard_bundle() is not None
+
+
+def _match_shard(faces, threshold):
+    """ Matches `faces` against this process shard, see match_bundle """
+    bundle = _shard_bundle()
+    if bundle is None:
+        return [(None, None, None)] * len(faces)
+    return match_bundle(bundle, faces, threshold)
+
+
+def find_people_sharded(image, faces, gallery, threshold):
+    """ find_people over a ShardedGallery `gallery`, faces are detected
+    in this process and sent to every shard """
+    with STATS.timer('faces.extract'):
+        crops = extract_faces(image)
+    if faces:
+        with STATS.timer('faces.save'):
+            save_faces(image, crops, faces)
+    with STATS.timer('faces.match'):
+        # PIL images don't pickle, shards get grayscale arrays
+        candidates = gallery.match([asarray(face.convert('L'))
+                                        for box, face in crops], threshold)
+    return reduce_result([(person, match, dist)
+                            for dist, match, person in candidates if match])
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('-p', '--people', default=PEOPLE_DIRECTORY,
+                      dest='people')
+    parser.add_option('-n', '--shards', type='int', default=None,
+                      dest='shards')
+    parser.add_option('-t', '--threshold', type='float', default=THRESHOLD,
+                      dest='threshold')
+    parser.add_option('-f', '--faces', dest='faces')
+    parser.add_option('-c', '--cache-dir', default=cache.CACHE_DIR,
+                      dest='cache_dir')
+    (options, images) = parser.parse_args()
+    cache.CACHE_DIR = options.cache_dir
+
+    if not images:
+        parser.print_help()
+        sys.exit(2)
+
+    gallery = ShardedGallery(options.people, options.shards)
+    try:
+        for image in images:
+            people = find_people_sharded(image, options.faces, gallery,
+                                         options.threshold)
+            print '%s: %s' % (basename(image),
+                              ', '.join('%s (%s %s)' % person
+                                            for person in people) or '-')
+    finally:
+        gallery.close()